@@ -1,32 +1,47 @@
 import argparse
+import numpy as np
 import tools as tl
+import ml_backends
 
 def main():
     args = parse_command_line()
     df = tl.read_csv_file(args.input_file)
     df = tl.rename_dataframe_columns(df)
     df = tl.convert_timestr_datetime(df)
-    df = tl.calculate_forecast_period_dataframe(df)
+    df = tl.calculate_forecast_period_dataframe(df, args.station_column)
     #df = tl.convert_kelvins_to_celsius(["T2", "D2", "SKT", "T_925"], df)
     df = tl.calculate_wind_speed(df)
-    df = tl.calculate_hourly_values_dataframe(["SRR1h", "STR1h"], df)
-    df = tl.select_only_forecast_from_df(df)
+    df = tl.calculate_hourly_values_dataframe(["SRR1h", "STR1h"], df, args.station_column)
+    df = tl.select_only_forecast_from_df(df, args.station_column)
     df = tl.calculate_angle_time_dataframe(df)
     ML_df = tl.select_forecast_params(df)
-    ML_model = tl.load_ML_model(args.ML_model)
-    t_trail_fcst = ML_model.predict(ML_df.values)
+    ML_model = tl.load_ML_model(args.ML_model, args.ML_backend)
+    # All stations are predicted in one call
+    t_trail_fcst = tl.predict_features(ML_model, ML_df.values.astype(np.float32))
     t_trail_fcst = t_trail_fcst - 273.15
+    if args.output_file is not None:
+        columns = [col for col in [args.station_column, 'time', 'lat', 'lon'] if col in df.columns]
+        result = df[columns].assign(rail_temperature=t_trail_fcst)
+        if args.output_file.endswith('.parquet'):
+            result.to_parquet(args.output_file, index=False)
+        else:
+            result.to_csv(args.output_file, sep=' ', index=False)
     print("homma done")
     # TODO: jotain plottailua voisi tehdä
 
 
 def parse_command_line():
     parser = argparse.ArgumentParser(argument_default=None)
-    parser.add_argument("--input_file", action="store", type=str, required=True)
+    parser.add_argument("--input_file", action="store", type=str, required=True,
+                        help="Point data of one or many stations in long format, CSV or Parquet")
     parser.add_argument("--ML_model", action="store", type=str, required=True)
+    parser.add_argument("--ML_backend", action="store", type=str, default="joblib", choices=ml_backends.BACKENDS)
+    parser.add_argument("--station_column", action="store", type=str, default=tl.STATION_COLUMN)
+    parser.add_argument("--output_file", action="store", type=str, default=None,
+                        help="Write the forecast of every station and time to a CSV or Parquet file")
     args = parser.parse_args()
     return args
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
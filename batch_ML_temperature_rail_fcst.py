@@ -0,0 +1,135 @@
+import os
+import sys
+import argparse
+import datetime
+import time
+import tools as tl
+import instrumentation as instr
+from concurrent.futures import ThreadPoolExecutor
+from file_utils import clone_template, configure_grid_cache
+from generate_ML_temperature_rail_fcst import read_predictors, forecast, add_processing_arguments, fetch_input_files, \
+    check_processing_arguments, check_track_point_output
+
+
+def main():
+    """Railtrack temperature forecasts for many analysis times in one process
+
+    The ML model, the lat/lon grid and the GRIB template are loaded once. Input
+    files of the next analysis time are read while the current one is predicted.
+    A failed analysis time is reported and the others are still forecast.
+    """
+    args = parse_command_line()
+    profiler = instr.start_profiler(args.profile, args.profile_file)
+    if args.cache_dir is not None:
+        tl.configure_file_cache(args.cache_dir, args.cache_size_gb)
+        configure_grid_cache(os.path.join(args.cache_dir, "grids"))
+    start_times = generate_start_times(args)
+    ML_model = tl.load_ML_model(args.ML_model, args.ML_backend)
+
+    def read_run(start_time, first_run):
+        data_files = tl.predictor_files_for_start_time(start_time, args.input_prefix)
+        forecast_params = data_files
+        try:
+            with instr.stage("fetch", start_time=start_time):
+                if not args.byte_range:
+                    forecast_params = fetch_input_files(data_files, args.workers)
+            with instr.stage("decode", start_time=start_time):
+                return read_predictors(forecast_params, args, read_template=first_run, read_coordinates=first_run)
+        finally:
+            remove_downloads(data_files, forecast_params)
+
+    template, latitudes, longitudes = None, None, None
+    failed = []
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        next_run = executor.submit(read_run, start_times[0], True)
+        for i, start_time in enumerate(start_times):
+            start = time.time()
+            try:
+                predictors = next_run.result()
+            except (Exception, SystemExit) as e:
+                predictors = None
+                failed.append(start_time)
+                print("Reading input of {} failed: {}".format(start_time, e))
+            if template is None and predictors is not None:
+                template = predictors.pop('template').template
+                latitudes, longitudes = predictors['T2'].latitudes, predictors['T2'].longitudes
+            if i + 1 < len(start_times):
+                next_run = executor.submit(read_run, start_times[i + 1], template is None)
+            if predictors is None:
+                continue
+            predictors['T2'].latitudes, predictors['T2'].longitudes = latitudes, longitudes
+            output_file = args.output_template.format(start_time=start_time)
+            instr.RECORDER.labels['start_time'] = start_time
+            try:
+                forecast(predictors, clone_template(template, predictors['T2'].analysis_time), ML_model, output_file, args)
+            except (Exception, SystemExit) as e:
+                failed.append(start_time)
+                print("Forecast {} failed: {}".format(start_time, e))
+                continue
+            print("Forecast {} done in {:.2f} seconds".format(start_time, time.time() - start))
+    if tl.FILE_CACHE is not None:
+        tl.FILE_CACHE.report()
+    if profiler is not None:
+        profiler.stop()
+    instr.RECORDER.report()
+    if args.metrics_file is not None:
+        instr.RECORDER.write(args.metrics_file)
+    if failed:
+        sys.exit("Forecasts of {} of {} analysis times failed: {}".format(len(failed), len(start_times),
+                                                                          " ".join(failed)))
+
+
+def remove_downloads(data_files: dict, local_files: dict):
+    """Remove the local copies of S3 input files and their GRIB indexes after decoding, unless cached
+
+    Without --cache_dir every analysis time would otherwise leave its input files
+    in the temporary download directory for the lifetime of the batch.
+    """
+    if tl.FILE_CACHE is not None:
+        return
+    for name, data_file in data_files.items():
+        local_file = local_files.get(name)
+        if not data_file.startswith("s3://") or local_file is None or local_file == data_file:
+            continue
+        for path in (local_file, local_file + ".idx.json"):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def generate_start_times(args) -> list:
+    if args.start_times is not None:
+        return args.start_times
+    date_format = '%Y%m%d%H%M'
+    start_time = datetime.datetime.strptime(args.start_time, date_format)
+    end_time = datetime.datetime.strptime(args.end_time, date_format)
+    start_times = []
+    while start_time <= end_time:
+        start_times.append(start_time.strftime(date_format))
+        start_time += datetime.timedelta(hours=args.interval_hours)
+    return start_times
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(argument_default=None)
+    parser.add_argument("--start_times", action="store", type=str, nargs="+", default=None,
+                        help="Analysis times as yyyymmddhhMM")
+    parser.add_argument("--start_time", action="store", type=str, default=None,
+                        help="First analysis time of a range as yyyymmddhhMM")
+    parser.add_argument("--end_time", action="store", type=str, default=None,
+                        help="Last analysis time of a range as yyyymmddhhMM")
+    parser.add_argument("--interval_hours", action="store", type=int, default=12)
+    parser.add_argument("--input_prefix", action="store", type=str, default="s3://trail/ec/")
+    parser.add_argument("--ML_model", action="store", type=str, required=True)
+    parser.add_argument("--output_template", action="store", type=str, required=True,
+                        help="Output file name with a {start_time} placeholder")
+    add_processing_arguments(parser)
+    args = parser.parse_args()
+    if args.start_times is None and (args.start_time is None or args.end_time is None):
+        parser.error("either --start_times or --start_time and --end_time are required")
+    check_track_point_output(parser, args, args.output_template, "--output_template")
+    check_processing_arguments(parser, args)
+    return args
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,248 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import tempfile
+import numpy as np
+import tools as tl
+from eccodes import (codes_grib_new_from_samples, codes_set, codes_set_values, codes_write, codes_release,
+                     codes_clone)
+from file_utils import WriteData
+from generate_ML_temperature_rail_fcst import read_predictors, build_dataset
+
+# EC output steps: hourly up to 90 h, 3-hourly up to 144 h and 6-hourly up to 240 h
+EC_STEPS = list(range(0, 91)) + list(range(93, 145, 3)) + list(range(150, 241, 6))
+
+BENCHMARK_START_TIME = "202410180000"
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def write_synthetic_grib(grib_file: str, param_name: str, ny: int, nx: int, steps: list, seed: int = 0,
+                         members: int = 1):
+    """Write an EC-like regular lat/lon GRIB2 file of one predictor with random but plausible values
+
+    With members > 1 the file holds an ensemble, one member after another.
+    """
+    rng = np.random.default_rng(seed)
+    with open(grib_file, "wb") as fp:
+        for member, step in [(member, step) for member in range(members) for step in steps]:
+            if step == steps[0]:
+                accumulated = np.zeros(ny * nx)
+            gh = codes_grib_new_from_samples("regular_ll_sfc_grib2")
+            codes_set(gh, "Ni", nx)
+            codes_set(gh, "Nj", ny)
+            codes_set(gh, "latitudeOfFirstGridPointInDegrees", 72.0)
+            codes_set(gh, "latitudeOfLastGridPointInDegrees", 72.0 - 0.1 * (ny - 1))
+            codes_set(gh, "longitudeOfFirstGridPointInDegrees", 5.0)
+            codes_set(gh, "longitudeOfLastGridPointInDegrees", 5.0 + 0.1 * (nx - 1))
+            codes_set(gh, "iDirectionIncrementInDegrees", 0.1)
+            codes_set(gh, "jDirectionIncrementInDegrees", 0.1)
+            codes_set(gh, "dataDate", int(BENCHMARK_START_TIME[:8]))
+            codes_set(gh, "dataTime", int(BENCHMARK_START_TIME[8:]))
+            codes_set(gh, "indicatorOfUnitOfTimeRange", 1)
+            codes_set(gh, "forecastTime", step)
+            codes_set(gh, "bitsPerValue", 16)
+            if members > 1:
+                codes_set(gh, "productDefinitionTemplateNumber", 1)
+                codes_set(gh, "perturbationNumber", member)
+                codes_set(gh, "numberOfForecastsInEnsemble", members)
+            if param_name in ('SRR1h', 'STR1h'):
+                # Radiation is accumulated from the analysis time
+                if step > 0:
+                    accumulated = accumulated + rng.uniform(0, 3600 * 300, ny * nx)
+                values = accumulated
+            elif param_name in ('LCC', 'MCC'):
+                values = rng.uniform(0, 100, ny * nx)
+            elif param_name == 'WS':
+                values = rng.gamma(2, 2.5, ny * nx)
+            else:
+                values = 275 + rng.normal(0, 5, ny * nx)
+            codes_set_values(gh, values)
+            codes_write(gh, fp)
+            codes_release(gh)
+
+
+def write_synthetic_model(model_file: str, trees: int = 50, seed: int = 0):
+    """Fit a small XGBoost model of the model columns to random data"""
+    import joblib
+    import pandas as pd
+    import xgboost as xgb
+    rng = np.random.default_rng(seed)
+    features = pd.DataFrame(rng.normal(size=(5000, len(tl.MODEL_COLUMNS))), columns=tl.MODEL_COLUMNS)
+    target = features.sum(axis=1) + 273.15
+    model = xgb.XGBRegressor(n_estimators=trees, max_depth=6).fit(features, target)
+    joblib.dump(model, model_file)
+
+
+def make_fixtures(work_dir: str, ny: int, nx: int, steps: int, members: int = 1) -> dict:
+    """Synthetic predictor files and ML model, reused when they already exist for the same size"""
+    fixture_dir = os.path.join(work_dir, "{}x{}x{}".format(ny, nx, steps))
+    if members > 1:
+        fixture_dir += "x{}".format(members)
+    os.makedirs(fixture_dir, exist_ok=True)
+    files = tl.predictor_files_for_start_time(BENCHMARK_START_TIME, prefix=fixture_dir + os.sep)
+    for seed, (param_name, grib_file) in enumerate(files.items()):
+        if not os.path.exists(grib_file):
+            write_synthetic_grib(grib_file + ".tmp", param_name, ny, nx, EC_STEPS[:steps], seed, members)
+            os.replace(grib_file + ".tmp", grib_file)
+    files['ML_model'] = os.path.join(work_dir, "model.joblib")
+    if not os.path.exists(files['ML_model']):
+        write_synthetic_model(files['ML_model'])
+    return files
+
+
+class StageTimer:
+    """Collects wall time and peak RSS of benchmarked stages over repeats"""
+    def __init__(self):
+        self.results = {}
+
+    def run(self, stage: str, cells: int, func, *args, **kwargs):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        stats = self.results.setdefault(stage, {'seconds': [], 'cells': cells})
+        stats['seconds'].append(seconds)
+        stats['peak_rss_mb'] = peak_rss_mb()
+        return result
+
+    def summary(self) -> dict:
+        summary = {}
+        for stage, stats in self.results.items():
+            best = min(stats['seconds'])
+            summary[stage] = {'best_seconds': best,
+                              'median_seconds': float(np.median(stats['seconds'])),
+                              'cells_per_second': stats['cells'] / best if best > 0 else None,
+                              'peak_rss_mb': stats['peak_rss_mb']}
+        return summary
+
+    def report(self):
+        print("{:<18s} {:>10s} {:>10s} {:>14s} {:>12s}".format("stage", "best s", "median s", "cells/s",
+                                                             "peak RSS MB"))
+        for stage, stats in self.summary().items():
+            print("{:<18s} {:10.3f} {:10.3f} {:14.3g} {:12.1f}".format(
+                stage, stats['best_seconds'], stats['median_seconds'], stats['cells_per_second'] or 0,
+                stats['peak_rss_mb']))
+
+
+def run_benchmark(files: dict, args) -> StageTimer:
+    timer = StageTimer()
+    forecast_params = {name: files[name] for name in tl.PREDICTOR_FILE_SUFFIXES}
+    model = tl.load_ML_model(files['ML_model'])
+    output_file = os.path.join(args.work_dir, "benchmark_output.grib2")
+    cells = args.ny * args.nx * args.steps * args.members
+    for repeat in range(args.repeat):
+        predictors = timer.run('read', cells * len(forecast_params), read_predictors, forecast_params, args)
+        template = predictors.pop('template').template
+        data = predictors['T2']
+        timer.run('masking', cells * len(predictors), lambda: [tl.mask_missing_data(p) for p in predictors.values()])
+        ds = timer.run('build_dataset', cells, build_dataset, predictors)
+        timer.run('forecast_period', cells, tl.calculate_forecast_period_dataset, data.dtime, ds.copy())
+        timer.run('hourly_values', cells, tl.calculate_hourly_values_dataset,
+                  predictors['SRR1h'].data, 'SRR1h', ds.copy())
+        timer.run('angle_time', cells, tl.calculate_angle_time_dataset, data.dtime, ds.copy())
+        forecast = timer.run('inference', cells, tl.generate_ML_forecast_domain, ds, model, data.data[..., 1:, :, :],
+                             chunk_size=args.chunk_size, workers=args.inference_workers)
+        if args.ensemble:
+            quantiles, _ = timer.run('ensemble_products', cells, tl.ensemble_products, forecast, [10, 50, 90], [313.15])
+            # The median stands for the written products
+            forecast = quantiles[1]
+        timer.run('write', cells, WriteData, forecast, codes_clone(template), output_file, 'local',
+                  time_series=data.dtime[1:], packing=args.packing, workers=args.encode_workers)
+        codes_release(template)
+        print("Repeat {}/{} done".format(repeat + 1, args.repeat))
+    os.remove(output_file)
+    return timer
+
+
+def dtype_parity(files: dict, args) -> float:
+    """Largest absolute forecast difference between the float64 and float32 data paths"""
+    forecast_params = {name: files[name] for name in tl.PREDICTOR_FILE_SUFFIXES}
+    model = tl.load_ML_model(files['ML_model'])
+    datasets, forecasts = {}, {}
+    for dtype in ['float64', 'float32']:
+        args.dtype = dtype
+        predictors = read_predictors(forecast_params, args, read_template=False)
+        for data in predictors.values():
+            tl.mask_missing_data(data)
+        datasets[dtype] = build_dataset(predictors)
+        forecasts[dtype] = tl.generate_ML_forecast_domain(datasets[dtype], model, predictors['T2'].data[..., 1:, :, :])
+    for col in tl.MODEL_COLUMNS:
+        difference = np.nanmax(np.abs(datasets['float64'][col].values - datasets['float32'][col].values))
+        print("{:<16s} max abs difference {:.3g}".format(col, difference))
+    difference = float(np.nanmax(np.abs(forecasts['float64'] - forecasts['float32'])))
+    print("{:<16s} max abs difference {:.3g}".format("forecast", difference))
+    return difference
+
+
+def main():
+    """Benchmark the forecast pipeline stages with synthetic EC-like input
+
+    Fixtures are generated once into --work_dir, results can be written to a JSON
+    file to compare branches.
+    """
+    args = parse_command_line()
+    if args.work_dir is None:
+        args.work_dir = os.path.join(tempfile.gettempdir(), "railtrack_benchmark")
+    os.makedirs(args.work_dir, exist_ok=True)
+    start = time.time()
+    files = make_fixtures(args.work_dir, args.ny, args.nx, args.steps, args.members)
+    print("Fixtures ready in {:.2f} seconds".format(time.time() - start))
+    if args.check_dtype_parity:
+        difference = dtype_parity(files, args)
+        if difference > args.tolerance:
+            sys.exit("float32 forecast differs from float64 by {:.3g} K".format(difference))
+        return
+    timer = run_benchmark(files, args)
+    timer.report()
+    if args.output_file is not None:
+        result = {'grid': [args.ny, args.nx], 'steps': args.steps, 'members': args.members, 'repeat': args.repeat,
+                  'dtype': args.dtype,
+                  'workers': args.workers, 'python': sys.version.split()[0], 'machine': platform.machine(),
+                  'cpu_count': os.cpu_count(), 'stages': timer.summary()}
+        with open(args.output_file, "w") as fp:
+            json.dump(result, fp, indent=2)
+        print("wrote file '%s'" % args.output_file)
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(argument_default=None)
+    parser.add_argument("--ny", action="store", type=int, default=200, help="Number of grid rows")
+    parser.add_argument("--nx", action="store", type=int, default=300, help="Number of grid columns")
+    parser.add_argument("--steps", action="store", type=int, default=len(EC_STEPS),
+                        help="Number of time steps including the analysis time, at most {}".format(len(EC_STEPS)))
+    parser.add_argument("--members", action="store", type=int, default=1,
+                        help="Number of ensemble members, more than one benchmarks the ensemble mode")
+    parser.add_argument("--repeat", action="store", type=int, default=3)
+    parser.add_argument("--work_dir", action="store", type=str, default=None,
+                        help="Directory of the synthetic fixtures, reused between runs")
+    parser.add_argument("--output_file", action="store", type=str, default=None,
+                        help="Write the stage results as JSON")
+    parser.add_argument("--workers", action="store", type=int, default=4)
+    parser.add_argument("--inference_workers", action="store", type=int, default=1)
+    parser.add_argument("--encode_workers", action="store", type=int, default=4)
+    parser.add_argument("--chunk_size", action="store", type=int, default=tl.INFERENCE_CHUNK_SIZE)
+    parser.add_argument("--packing", action="store", type=str, default=None, choices=["grid_simple", "grid_ccsds"])
+    parser.add_argument("--dtype", action="store", type=str, default="float32", choices=["float32", "float64"])
+    parser.add_argument("--check_dtype_parity", action="store_true", default=False,
+                        help="Compare the float32 and float64 data paths instead of timing")
+    parser.add_argument("--tolerance", action="store", type=float, default=0.05,
+                        help="Largest accepted forecast difference in K of the parity check")
+    parser.add_argument("--preallocate", action="store_true", default=False)
+    parser.add_argument("--scratch_dir", action="store", type=str, default=None)
+    args = parser.parse_args()
+    if not 2 <= args.steps <= len(EC_STEPS):
+        parser.error("--steps must be between 2 and {}".format(len(EC_STEPS)))
+    args.ensemble = args.members > 1
+    args.byte_range = False
+    return args
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+from __future__ import annotations
+import time
+import base64
+import datetime
+import numpy as np
+import tools as tl
+from lazy_imports import lazy_import
+from file_utils import s3_write_options
+
+xr = lazy_import("xarray")
+eccodes = lazy_import("eccodes")
+
+
+def feature_store_path(feature_store: str, analysis_time: datetime.datetime) -> str:
+    return "{}/{}.zarr".format(feature_store.rstrip("/"), analysis_time.strftime("%Y%m%d%H%M"))
+
+
+def storage_options(path: str) -> dict:
+    return s3_write_options() if path.startswith("s3://") else None
+
+
+def write_feature_store(ds: xr.Dataset, template, feature_store: str, analysis_time: datetime.datetime,
+                        chunk_size: int = tl.INFERENCE_CHUNK_SIZE, tile_size: int = None) -> str:
+    """Persist the model features of one analysis time as a chunked, compressed Zarr store
+
+    Chunks follow the inference tiles (time steps x grid rows), so predicting from
+    the store reads every chunk once. The output GRIB template is kept in the
+    attributes, which makes the store enough to rerun inference and writing.
+    """
+    start = time.time()
+    store_path = feature_store_path(feature_store, analysis_time)
+    *members, steps, ny, nx = ds['T2'].shape
+    rows = ny if tile_size is None else min(tile_size, ny)
+    steps_per_chunk = min(steps, max(1, chunk_size // (rows * nx * int(np.prod(members)))))
+    features = ds[tl.MODEL_COLUMNS]
+    features.attrs = dict(ds.attrs, analysis_time=analysis_time.isoformat(),
+                          grib_template=base64.b64encode(eccodes.codes_get_message(template)).decode())
+    # Ensemble members stay in the same chunk like in the inference tiles
+    encoding = {col: {'chunks': tuple(members) + (steps_per_chunk, rows, nx)} for col in tl.MODEL_COLUMNS}
+    features.to_zarr(store_path, mode="w", encoding=encoding, storage_options=storage_options(store_path))
+    print("Wrote feature store {} in {:.2f} seconds".format(store_path, time.time() - start))
+    return store_path
+
+
+def open_feature_store(store_path: str):
+    """Lazily opened features and the GRIB template of a feature store
+
+    Values are read chunk by chunk when the dataset is indexed, e.g.
+    ds[col][times, rows].values, so inference streams the store.
+    """
+    ds = xr.open_zarr(store_path, chunks=None, storage_options=storage_options(store_path))
+    template = eccodes.codes_new_from_message(base64.b64decode(ds.attrs['grib_template']))
+    return ds, template
@@ -0,0 +1,51 @@
+import numpy as np
+
+
+def forecast_period_hours(times) -> np.ndarray:
+    """Whole hours from the first (analysis) time to every time"""
+    times = np.asarray(times, dtype="datetime64[s]")
+    return ((times - times[0]) // np.timedelta64(1, "h")).astype(float)
+
+
+def time_angle_features(times) -> dict:
+    """Cyclic hour and month features of the forecast times"""
+    times = np.asarray(times, dtype="datetime64[s]")
+    hour = (times.astype("datetime64[h]") - times.astype("datetime64[D]")).astype(int)
+    month = times.astype("datetime64[M]").astype(int) % 12 + 1
+    return {'sinhour': np.round(np.sin(hour * 2 * np.pi / 24), 2),
+            'coshour': np.round(np.cos(hour * 2 * np.pi / 24), 2),
+            'sinmonth': np.round(np.sin(month * 2 * np.pi / 12), 2),
+            'cosmonth': np.round(np.cos(month * 2 * np.pi / 12), 2),
+            'month': month.astype(float)}
+
+
+def broadcast_over_domain(values: np.ndarray, shape: tuple, axis: int = 0) -> np.ndarray:
+    """Read-only zero-copy view of per-time values repeated over the grid (and members) of shape
+
+    axis is the time axis of shape, e.g. 1 for (member, time, y, x).
+    """
+    values = np.asarray(values)
+    return np.broadcast_to(values.reshape((1,) * axis + (-1,) + (1,) * (len(shape) - axis - 1)), shape)
+
+
+def time_step_increments(forecast_period: np.ndarray) -> np.ndarray:
+    """Hours between EC output steps: hourly up to 90 h, 3-hourly up to 144 h, 6-hourly after"""
+    return np.where(forecast_period >= 144, 6, np.where(forecast_period >= 90, 3, 1))
+
+
+def hourly_values(data: np.ndarray, forecast_period: np.ndarray, dtype=None, axis: int = 0) -> np.ndarray:
+    """De-accumulate fields accumulated since the analysis time to mean values per second
+
+    data contains the analysis time as the first step of its time axis, forecast_period
+    the lead times of the following steps. Returns an array of dtype (data.dtype by
+    default) without the analysis time step.
+    """
+    shape = list(data.shape)
+    shape[axis] -= 1
+    hourly = np.empty(shape=shape, dtype=dtype or data.dtype)
+    increments = (time_step_increments(forecast_period[1:]) * 3600).astype(data.dtype)
+    # Views with time first, every member is de-accumulated in the same operation
+    steps, accumulated = np.moveaxis(hourly, axis, 0), np.moveaxis(data, axis, 0)
+    steps[0] = accumulated[1] / 3600
+    steps[1:] = (accumulated[2:] - accumulated[1:-1]) / increments.reshape((-1,) + (1,) * (data.ndim - 1))
+    return hourly
@@ -0,0 +1,155 @@
+import os
+import time
+import argparse
+import hashlib
+import threading
+from lazy_imports import lazy_import
+
+fsspec = lazy_import("fsspec")
+
+S3_ENDPOINTS = ['https://routines-data.lake.fmi.fi', 'https://lake.fmi.fi']
+if "S3_ENDPOINT_URL" in os.environ:
+    S3_ENDPOINTS = [os.environ["S3_ENDPOINT_URL"]]
+
+
+class FileCache:
+    """Persistent local cache for remote input files
+
+    Files are stored in a directory of their URI under a key derived from the ETag
+    and size of the remote object, so a changed object is downloaded again while
+    identical inputs of consecutive runs are served from disk. The superseded version
+    of a changed object is removed, and the least recently used files are evicted
+    when the cache grows over max_size bytes.
+    """
+    def __init__(self, cache_dir: str, max_size: int = None, endpoints: list = None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.endpoints = endpoints or S3_ENDPOINTS
+        self.hits = 0
+        self.misses = 0
+        self.bytes_downloaded = 0
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get(self, uri: str) -> str:
+        """Return a local path of uri, downloading it on a cache miss"""
+        fs, info = self.find_object(uri)
+        uri_key = hashlib.sha256(uri.encode()).hexdigest()
+        key = hashlib.sha256("{}|{}|{}".format(uri, info.get('ETag', ''), info['size']).encode()).hexdigest()
+        local_file = os.path.join(self.cache_dir, uri_key[:2], uri_key[:16],
+                                  "{}_{}".format(key[:16], os.path.basename(uri)))
+        if os.path.exists(local_file):
+            # mtime records the last use for LRU eviction
+            os.utime(local_file)
+            with self.lock:
+                self.hits += 1
+            return local_file
+
+        start = time.time()
+        os.makedirs(os.path.dirname(local_file), exist_ok=True)
+        tmp_file = "{}.{}.{}.tmp".format(local_file, os.getpid(), threading.get_ident())
+        fs.get_file(uri, tmp_file)
+        os.replace(tmp_file, local_file)
+        with self.lock:
+            self.misses += 1
+            self.bytes_downloaded += info['size']
+        print("Downloaded {} ({:.1f} MB) in {:.2f} seconds".format(uri, info['size'] / 1e6, time.time() - start))
+        self.remove_superseded(local_file)
+        self.evict(keep=local_file)
+        return local_file
+
+    def find_object(self, uri: str):
+        return find_s3_object(uri, self.endpoints)
+
+    def cached_files(self) -> list:
+        files = []
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                if not name.endswith((".tmp", ".idx.json")):
+                    files.append(os.path.join(root, name))
+        return files
+
+    def remove_superseded(self, local_file: str):
+        """Remove the other cached versions of the object of local_file"""
+        uri_dir = os.path.dirname(local_file)
+        with self.lock:
+            for name in os.listdir(uri_dir):
+                cached_file = os.path.join(uri_dir, name)
+                if cached_file == local_file or name.endswith((".tmp", ".idx.json")):
+                    continue
+                self.remove(cached_file)
+                print("Removed superseded version {} from cache".format(cached_file))
+
+    def remove(self, cached_file: str):
+        for path in (cached_file, cached_file + ".idx.json"):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def evict(self, keep: str = None):
+        if self.max_size is None:
+            return
+        with self.lock:
+            files = sorted(self.cached_files(), key=lambda f: os.stat(f).st_mtime)
+            total = sum(os.stat(f).st_size for f in files)
+            for cached_file in files:
+                if total <= self.max_size:
+                    break
+                if cached_file == keep:
+                    continue
+                total -= os.stat(cached_file).st_size
+                self.remove(cached_file)
+                print("Evicted {} from cache".format(cached_file))
+
+    def stats(self) -> dict:
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'bytes_downloaded': self.bytes_downloaded,
+                'cache_size': sum(os.stat(f).st_size for f in self.cached_files())}
+
+    def report(self):
+        stats = self.stats()
+        print("File cache {}: {} hits, {} misses, downloaded {:.1f} MB, cache size {:.1f} MB".format(
+            self.cache_dir, stats['hits'], stats['misses'], stats['bytes_downloaded'] / 1e6, stats['cache_size'] / 1e6))
+
+
+def find_s3_object(uri: str, endpoints: list = None):
+    """Anonymous S3 filesystem of the first endpoint holding uri, and the info of the object"""
+    for endpoint_url in endpoints or S3_ENDPOINTS:
+        fs = fsspec.filesystem('s3', anon=True, client_kwargs={'endpoint_url': endpoint_url})
+        # Objects may be replaced by newer versions while the process runs
+        fs.invalidate_cache(uri)
+        try:
+            return fs, fs.info(uri)
+        except FileNotFoundError:
+            continue
+    raise FileNotFoundError(uri)
+
+
+def main():
+    """Pre-warm the file cache with the input files of an analysis time"""
+    import tools as tl
+    args = parse_command_line()
+    cache = tl.configure_file_cache(args.cache_dir, args.cache_size_gb)
+    uris = list(tl.predictor_files_for_start_time(args.start_time, args.input_prefix).values())
+    if args.ML_model is not None and args.ML_model.startswith("s3://"):
+        uris.append(args.ML_model)
+    for uri in uris:
+        cache.get(uri)
+    cache.report()
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(argument_default=None)
+    parser.add_argument("--start_time", action="store", type=str, required=True)
+    parser.add_argument("--cache_dir", action="store", type=str, required=True)
+    parser.add_argument("--cache_size_gb", action="store", type=float, default=None)
+    parser.add_argument("--input_prefix", action="store", type=str, default="s3://trail/ec/")
+    parser.add_argument("--ML_model", action="store", type=str, default=None)
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    main()
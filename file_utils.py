@@ -1,24 +1,313 @@
-from eccodes import *
 import sys
 import time
 import datetime
 import numpy as np
 import os
-import fsspec
 from tools import read_file_from_s3, sort_array_by_time_series, generate_sorter
 import gc
+import tempfile
+import json
+import hashlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from lazy_imports import lazy_import
+import remote_grib
+
+# eccodes is imported on first use, eccodes calls are qualified for that
+eccodes = lazy_import("eccodes")
+fsspec = lazy_import("fsspec")
 
 GRIB_MESSAGE_STEP = None
 
 
+def read_leadtime(gh):
+    tr = eccodes.codes_get_long(gh, "indicatorOfUnitOfTimeRange")
+    ft = eccodes.codes_get_long(gh, "forecastTime")
+    if tr == 1:
+        return datetime.timedelta(hours=ft)
+    if tr == 0:
+        return datetime.timedelta(minutes=ft)
+    raise Exception("Unknown indicatorOfUnitOfTimeRange: {:%d}".format(tr))
+
+
+def allocate_array(shape, dtype, scratch_dir: str = None):
+    """Allocate an uninitialized array, memory-mapped to an unlinked file in scratch_dir if given"""
+    if scratch_dir is None:
+        return np.empty(shape=shape, dtype=dtype)
+    fd, path = tempfile.mkstemp(dir=scratch_dir, suffix=".dat")
+    os.close(fd)
+    data = np.memmap(path, dtype=dtype, mode="w+", shape=shape)
+    # The mapping keeps the storage alive, the file is freed with the array
+    os.remove(path)
+    return data
+
+
+# Directory of cached grid coordinates, None keeps them only in memory
+GRID_CACHE_DIR = os.environ.get("RAILTRACK_GRID_CACHE_DIR", os.path.join(tempfile.gettempdir(), "railtrack_grids"))
+GRID_COORDINATES = {}
+
+
+def configure_grid_cache(cache_dir: str):
+    global GRID_CACHE_DIR
+    GRID_CACHE_DIR = cache_dir
+
+
+def grid_hash(gh) -> str:
+    """Hash of the grid definition (geography keys) of a GRIB message"""
+    keys = []
+    iterator = eccodes.codes_keys_iterator_new(gh, "geography")
+    while eccodes.codes_keys_iterator_next(iterator):
+        key = eccodes.codes_keys_iterator_get_name(iterator)
+        if eccodes.codes_get_size(gh, key) == 1:
+            keys.append("{}={}".format(key, eccodes.codes_get_string(gh, key)))
+        else:
+            keys.append("{}={}".format(key, eccodes.codes_get_array(gh, key).tolist()))
+    eccodes.codes_keys_iterator_delete(iterator)
+    if eccodes.codes_is_defined(gh, "md5GridSection"):
+        # Also covers the shape of the earth and other grid section keys
+        keys.append("md5GridSection={}".format(eccodes.codes_get_string(gh, "md5GridSection")))
+    return hashlib.sha1(";".join(keys).encode()).hexdigest()[:16]
+
+
+def grid_coordinates(gh):
+    """Read-only 2-D latitudes and longitudes of the grid of a GRIB message
+
+    Coordinates are decoded once per grid definition, kept in memory and cached
+    as .npy files in GRID_CACHE_DIR for later runs.
+    """
+    key = grid_hash(gh)
+    if key in GRID_COORDINATES:
+        return GRID_COORDINATES[key]
+    shape = (eccodes.codes_get_long(gh, "Nj"), eccodes.codes_get_long(gh, "Ni"))
+    files = None
+    if GRID_CACHE_DIR is not None:
+        files = [os.path.join(GRID_CACHE_DIR, "grid_{}_{}.npy".format(key, name)) for name in ("latitudes", "longitudes")]
+    try:
+        coordinates = tuple(np.load(grid_file) for grid_file in files)
+        if any(c.shape != shape for c in coordinates):
+            raise ValueError("Cached grid shape differs")
+    except (TypeError, OSError, ValueError):
+        coordinates = (eccodes.codes_get_array(gh, "latitudes").reshape(shape),
+                       eccodes.codes_get_array(gh, "longitudes").reshape(shape))
+        if files is not None:
+            save_grid_coordinates(coordinates, files)
+    for c in coordinates:
+        c.flags.writeable = False
+    GRID_COORDINATES[key] = coordinates
+    return coordinates
+
+
+def save_grid_coordinates(coordinates: tuple, files: list):
+    try:
+        os.makedirs(os.path.dirname(files[0]), exist_ok=True)
+        for values, grid_file in zip(coordinates, files):
+            tmp_file = "{}.{}.tmp.npy".format(grid_file[:-4], os.getpid())
+            np.save(tmp_file, values)
+            os.replace(tmp_file, grid_file)
+    except OSError as e:
+        print("Could not write grid coordinates {}: {}".format(files[0], e))
+
+
+GRIB_INDEX_KEYS = ["dataDate", "dataTime", "discipline", "parameterCategory", "parameterNumber",
+                   "typeOfFirstFixedSurface", "level"]
+
+# Version of the sidecar index format, older index files are rebuilt
+GRIB_INDEX_VERSION = 2
+
+
+def build_grib_index(grib_file: str) -> list:
+    """Scan message headers of a local GRIB file for byte offsets, lengths and lead times
+
+    A truncated last message of a file still being written is left out.
+    """
+    messages = []
+    with open(grib_file, "rb") as fp:
+        while True:
+            offset = fp.tell()
+            try:
+                gh = eccodes.codes_grib_new_from_file(fp, headers_only=True)
+            except eccodes.PrematureEndOfFileError:
+                print("GRIB file {} ends with a truncated message at byte {}".format(grib_file, offset))
+                break
+            if gh is None:
+                break
+            messages.append(grib_index_entry(gh, offset, fp.tell() - offset))
+            eccodes.codes_release(gh)
+    return messages
+
+
+def grib_index_entry(gh, offset: int, length: int) -> dict:
+    entry = {"offset": offset,
+             "length": length,
+             "leadtime": int(read_leadtime(gh).total_seconds() / 60)}
+    for key in GRIB_INDEX_KEYS:
+        entry[key] = eccodes.codes_get_long(gh, key)
+    # Ensemble member, 0 for deterministic forecasts
+    entry["member"] = 0
+    if eccodes.codes_is_defined(gh, "perturbationNumber"):
+        entry["member"] = eccodes.codes_get_long(gh, "perturbationNumber")
+    return entry
+
+
+def load_grib_index(grib_file: str, index_file: str = None) -> list:
+    """Return the message index of grib_file, building the sidecar index file if missing or stale"""
+    index_file = index_file or grib_file + ".idx.json"
+    stat = os.stat(grib_file)
+    try:
+        with open(index_file) as fp:
+            index = json.load(fp)
+        if (index.get("version") == GRIB_INDEX_VERSION and index["size"] == stat.st_size
+                and index["mtime_ns"] == stat.st_mtime_ns):
+            return index["messages"]
+    except (OSError, ValueError, KeyError):
+        pass
+    messages = build_grib_index(grib_file)
+    try:
+        # Write atomically, concurrent readers of the same file may build the index simultaneously
+        tmp_file = "{}.{}.tmp".format(index_file, os.getpid())
+        with open(tmp_file, "w") as fp:
+            json.dump({"version": GRIB_INDEX_VERSION, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+                       "messages": messages}, fp)
+        os.replace(tmp_file, index_file)
+    except OSError as e:
+        print("Could not write GRIB index {}: {}".format(index_file, e))
+    return messages
+
+
+class GribFile:
+    """Lazy random access to the messages of a GRIB file by lead time
+
+    Messages are ordered chronologically. Indexing with an integer or a slice
+    decodes only the selected messages, get() selects a message by lead time.
+    Messages of an ensemble file are limited to one member if member is given.
+    With byte_range an S3 file is not downloaded, only the decoded messages are
+    fetched with range requests.
+    """
+    def __init__(self, data_file: str, index_file: str = None, dtype=np.float32, member: int = None,
+                 byte_range: bool = False):
+        self.data_file = data_file
+        self.dtype = np.dtype(dtype)
+        self.local_file = data_file
+        self.reader = None
+        if data_file.startswith("s3://") and byte_range:
+            self.local_file = None
+            self.reader = remote_grib.RangeReader(data_file)
+            messages = remote_grib.load_remote_grib_index(self.reader)
+        else:
+            if data_file.startswith("s3://"):
+                self.local_file = read_file_from_s3(data_file)
+            messages = load_grib_index(self.local_file, index_file)
+        self.messages = sorted(messages, key=lambda m: m["leadtime"])
+        if member is not None:
+            self.messages = [message for message in self.messages if message["member"] == member]
+        self._latitudes = None
+        self._longitudes = None
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return np.asarray([self.read_values(message) for message in self.messages[item]])
+        return self.read_values(self.messages[item])
+
+    @property
+    def leadtimes(self) -> list:
+        return [datetime.timedelta(minutes=message["leadtime"]) for message in self.messages]
+
+    @property
+    def members(self) -> list:
+        """Ensemble members (perturbationNumber) of the file, [0] for a deterministic forecast"""
+        return sorted({message["member"] for message in self.messages})
+
+    @property
+    def analysis_time(self) -> datetime.datetime:
+        message = self.messages[0]
+        return datetime.datetime.strptime("{:d}/{:04d}".format(message["dataDate"], message["dataTime"]), "%Y%m%d/%H%M")
+
+    @property
+    def latitudes(self):
+        if self._latitudes is None:
+            self.read_coordinates()
+        return self._latitudes
+
+    @property
+    def longitudes(self):
+        if self._longitudes is None:
+            self.read_coordinates()
+        return self._longitudes
+
+    def find(self, leadtime, member: int = None) -> dict:
+        if not isinstance(leadtime, datetime.timedelta):
+            leadtime = datetime.timedelta(hours=leadtime)
+        for message in self.messages:
+            if message["leadtime"] == int(leadtime.total_seconds() / 60) and member in (None, message["member"]):
+                return message
+        raise KeyError("Leadtime {} of member {} not found in {}".format(leadtime, member, self.data_file))
+
+    def get(self, leadtime):
+        """Decode the message of a lead time given as timedelta or hours"""
+        return self.read_values(self.find(leadtime))
+
+    def read_handle(self, message: dict):
+        if self.reader is not None:
+            return eccodes.codes_new_from_message(
+                self.reader.read(message["offset"], message["offset"] + message["length"]))
+        with open(self.local_file, "rb") as fp:
+            fp.seek(message["offset"])
+            return eccodes.codes_new_from_message(fp.read(message["length"]))
+
+    def read_handles(self, messages: list):
+        """Yield handles of messages in order, remote messages are fetched in batches of concurrent range requests"""
+        if self.reader is None:
+            for message in messages:
+                yield self.read_handle(message)
+            return
+        for start in range(0, len(messages), remote_grib.FETCH_BATCH):
+            batch = messages[start:start + remote_grib.FETCH_BATCH]
+            ranges = [(message["offset"], message["offset"] + message["length"]) for message in batch]
+            for data in self.reader.read_ranges(ranges):
+                yield eccodes.codes_new_from_message(data)
+
+    @property
+    def bytes_fetched(self) -> int:
+        """Bytes transferred by range requests, 0 for local files"""
+        return 0 if self.reader is None else self.reader.bytes_read
+
+    def read_values(self, message: dict):
+        gh = self.read_handle(message)
+        values = eccodes.codes_get_values(gh).reshape(eccodes.codes_get_long(gh, "Nj"), eccodes.codes_get_long(gh, "Ni"))
+        eccodes.codes_release(gh)
+        return values.astype(self.dtype, copy=False)
+
+    def read_coordinates(self):
+        gh = self.read_handle(self.messages[0])
+        self._latitudes, self._longitudes = grid_coordinates(gh)
+        eccodes.codes_release(gh)
+
+
 class ReadData:
     def __init__(self, data_file: str,
                  added_hours: int = 0,
                  time_steps: int = 0,
                  read_coordinates: bool = False,
                  use_as_template: bool = False,
-                 missing_data: bool = False):
+                 missing_data: bool = False,
+                 preallocate: bool = False,
+                 scratch_dir: str = None,
+                 leadtimes: list = None,
+                 dtype=np.float32,
+                 members: list = None,
+                 byte_range: bool = False):
         self.data_file = data_file
+        self.dtype = np.dtype(dtype)
+        # Selecting lead times or ensemble members and range requests require the indexed, preallocated decoding
+        self.preallocate = preallocate or leadtimes is not None or members is not None or byte_range
+        self.leadtimes = leadtimes
+        self.members = members
+        self.byte_range = byte_range
+        self.bytes_fetched = 0
+        self.scratch_dir = scratch_dir
         self.data = None
         self.mask_nodata = None
         self.latitudes = None
@@ -27,15 +316,26 @@ class ReadData:
         self.dtime = None
         self.forecast_time = None
         self.analysis_time = None
+        self.fetch_seconds = 0.0
+        self.decode_seconds = 0.0
         self.read(added_hours, read_coordinates, use_as_template, time_steps, missing_data)
-        # Sort arrays chronologically from the oldest to the newest
-        sorter = generate_sorter(self.dtime)
-        self.dtime = sort_array_by_time_series(self.dtime, sorter)
-        self.data = sort_array_by_time_series(self.data, sorter)
+        if not self.preallocate:
+            # Sort arrays chronologically from the oldest to the newest
+            sorter = generate_sorter(self.dtime)
+            self.dtime = sort_array_by_time_series(self.dtime, sorter)
+            self.data = sort_array_by_time_series(self.data, sorter)
+
+    @classmethod
+    def open(cls, data_file: str, index_file: str = None, dtype=np.float32, member: int = None,
+             byte_range: bool = False) -> GribFile:
+        """Open a GRIB file for lazy per-leadtime access without decoding it"""
+        return GribFile(data_file, index_file, dtype, member, byte_range)
 
     def read(self, added_hours, read_coordinates, use_as_template, time_steps, missing_data):
         print(f"Reading {self.data_file}")
-        if self.data_file.endswith(".grib2"):
+        if self.data_file.endswith(".grib2") and self.preallocate:
+            self.read_grib_preallocated(added_hours, read_coordinates, use_as_template, time_steps, missing_data)
+        elif self.data_file.endswith(".grib2"):
             self.read_grib(added_hours, read_coordinates, use_as_template, time_steps, missing_data)
         else:
             sys.exit("unsupported file type for file: %s" % (self.data_file))
@@ -44,53 +344,44 @@ class ReadData:
         global GRIB_MESSAGE_STEP
         start = time.time()
 
-        def read_leadtime(gh):
-            tr = codes_get_long(gh, "indicatorOfUnitOfTimeRange")
-            ft = codes_get_long(gh, "forecastTime")
-            if tr == 1:
-                return datetime.timedelta(hours=ft)
-            if tr == 0:
-                return datetime.timedelta(minutes=ft)
-            raise Exception("Unknown indicatorOfUnitOfTimeRange: {:%d}".format(tr))
-
         data_ls = []
-        latitudes_ls = []
-        longitudes_ls = []
         dtime_ls = []
         wrk_data_file = self.data_file
 
         if self.data_file.startswith("s3://"):
             wrk_data_file = read_file_from_s3(self.data_file)
-            
+        self.fetch_seconds = time.time() - start
+
         with open(wrk_data_file) as fp:
             while True:
-                gh = codes_grib_new_from_file(fp)
+                gh = eccodes.codes_grib_new_from_file(fp)
                 if gh is None:
                     break
 
-                ni = codes_get_long(gh, "Ni")
-                nj = codes_get_long(gh, "Nj")
-                data_date = codes_get_long(gh, "dataDate")
-                data_time = codes_get_long(gh, "dataTime")
+                ni = eccodes.codes_get_long(gh, "Ni")
+                nj = eccodes.codes_get_long(gh, "Nj")
+                data_date = eccodes.codes_get_long(gh, "dataDate")
+                data_time = eccodes.codes_get_long(gh, "dataTime")
                 lt = read_leadtime(gh)
                 self.analysis_time = datetime.datetime.strptime("{:d}/{:04d}".format(data_date, data_time), "%Y%m%d/%H%M")
                 self.forecast_time = datetime.datetime.strptime("{:d}/{:04d}".format(data_date, data_time), "%Y%m%d/%H%M") + lt
                 dtime_ls.append(self.forecast_time)
-                values = np.asarray(codes_get_values(gh))
+                # eccodes decodes to float64, which the model and 24-bit output never need
+                values = eccodes.codes_get_values(gh).astype(self.dtype, copy=False)
                 data_ls.append(values.reshape(nj, ni))
-                if read_coordinates:
-                    latitudes_ls.append(np.asarray(codes_get_array(gh, "latitudes").reshape(nj, ni)))
-                    longitudes_ls.append(np.asarray(codes_get_array(gh, "longitudes").reshape(nj, ni)))
+                if read_coordinates and self.latitudes is None:
+                    # All messages of a file share the grid
+                    self.latitudes, self.longitudes = grid_coordinates(gh)
 
                 if use_as_template:
-                    self.template = codes_clone(gh)
+                    self.template = eccodes.codes_clone(gh)
                     if GRIB_MESSAGE_STEP is None and lt > datetime.timedelta(minutes=0):
                         GRIB_MESSAGE_STEP = lt
-                if codes_get_long(gh, "numberOfMissing") == ni*nj and missing_data is False:
+                if eccodes.codes_get_long(gh, "numberOfMissing") == ni*nj and missing_data is False:
                     print("File {} leadtime {} contains only missing data!".format(self.data_file, lt))
                     sys.exit(1)
 
-                codes_release(gh)
+                eccodes.codes_release(gh)
 
                 if len(dtime_ls) > time_steps:
                     fp.close()
@@ -100,97 +391,249 @@ class ReadData:
                     break
 
         self.data = np.asarray(data_ls)
-        if len(latitudes_ls) > 0:
-            self.latitudes = np.asarray(latitudes_ls)
-            self.longitudes = np.asarray(longitudes_ls)
-            self.latitudes = self.latitudes[0, :, :]
-            self.longitudes = self.longitudes[0, :, :]
 
         self.mask_nodata = np.ma.masked_where(self.data == 9999, self.data)
         if type(dtime_ls) == list:
             self.dtime = np.array([(i+datetime.timedelta(hours=added_hours)) for i in dtime_ls])
+        self.decode_seconds = time.time() - start - self.fetch_seconds
+        print("Read {} in {:.2f} seconds".format(self.data_file, time.time() - start))
+
+    def read_grib_preallocated(self, added_hours, read_coordinates, use_as_template, time_steps, missing_data):
+        """Decode messages straight into one preallocated (time, nj, ni) array of self.dtype
+
+        The GRIB index gives the lead times and byte offsets of the messages, so every
+        message is decoded directly into its chronological slot without intermediate
+        copies. If lead times were requested only those messages are decoded. With
+        members the array is (member, time, nj, ni), the lead times of every member
+        being those of the first one. With byte_range only the decoded messages of an
+        S3 file are fetched, in batches of concurrent range requests.
+        """
+        global GRIB_MESSAGE_STEP
+        start = time.time()
+        grib_file = GribFile(self.data_file, dtype=self.dtype, byte_range=self.byte_range)
+        self.fetch_seconds = time.time() - start
+
+        member = self.members[0] if self.members is not None else None
+        if self.leadtimes is not None:
+            messages = [grib_file.find(lt, member) for lt in self.leadtimes]
+        else:
+            # Same messages as the sequential reader: the first time_steps + 1 in file order
+            messages = [message for message in grib_file.messages if member in (None, message["member"])]
+            messages = sorted(messages, key=lambda m: m["offset"])[:time_steps + 1]
+            messages = sorted(messages, key=lambda m: m["leadtime"])
+        slots = [((slot,), message) for slot, message in enumerate(messages)]
+        shape = (len(messages),)
+        if self.members is not None:
+            by_member = {(message["member"], message["leadtime"]): message for message in grib_file.messages}
+            try:
+                slots = [((m, slot), by_member[(member, message["leadtime"])])
+                         for m, member in enumerate(self.members) for slot, message in enumerate(messages)]
+            except KeyError as e:
+                sys.exit("Member and lead time {} not found in {}".format(e, self.data_file))
+            shape = (len(self.members), len(messages))
+
+        self.data = None
+        self.dtime = np.empty(len(messages), dtype=object)
+        handles = grib_file.read_handles([message for _, message in slots])
+        for (index, message), gh in zip(slots, handles):
+            ni = eccodes.codes_get_long(gh, "Ni")
+            nj = eccodes.codes_get_long(gh, "Nj")
+            if self.data is None:
+                self.data = allocate_array(shape + (nj, ni), self.dtype, self.scratch_dir)
+            lt = read_leadtime(gh)
+            data_date = eccodes.codes_get_long(gh, "dataDate")
+            data_time = eccodes.codes_get_long(gh, "dataTime")
+            self.analysis_time = datetime.datetime.strptime("{:d}/{:04d}".format(data_date, data_time), "%Y%m%d/%H%M")
+            self.forecast_time = self.analysis_time + lt
+            self.dtime[index[-1]] = self.forecast_time + datetime.timedelta(hours=added_hours)
+            self.data[index] = eccodes.codes_get_values(gh).reshape(nj, ni)
+            if read_coordinates and self.latitudes is None:
+                self.latitudes, self.longitudes = grid_coordinates(gh)
+            if use_as_template:
+                if self.template is not None:
+                    eccodes.codes_release(self.template)
+                self.template = eccodes.codes_clone(gh)
+                if GRIB_MESSAGE_STEP is None and lt > datetime.timedelta(minutes=0):
+                    GRIB_MESSAGE_STEP = lt
+            if eccodes.codes_get_long(gh, "numberOfMissing") == ni*nj and missing_data is False:
+                print("File {} leadtime {} contains only missing data!".format(self.data_file, lt))
+                sys.exit(1)
+            eccodes.codes_release(gh)
+
+        self.bytes_fetched = grib_file.bytes_fetched
+        self.decode_seconds = time.time() - start - self.fetch_seconds
         print("Read {} in {:.2f} seconds".format(self.data_file, time.time() - start))
 
 
+def read_data_concurrently(data_files: dict, read_options: dict, workers: int = 4) -> dict:
+    """Read independent GRIB files in a thread pool
+
+    eccodes releases the GIL while decoding, so both the S3 fetch and the decoding
+    of different files overlap. Returns ReadData objects keyed like data_files.
+    """
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {name: executor.submit(ReadData, data_file, **read_options.get(name, {}))
+                   for name, data_file in data_files.items()}
+        data_objects = {name: future.result() for name, future in futures.items()}
+    for name, data_object in data_objects.items():
+        print("{:<10s} fetch {:6.2f} s, decode {:6.2f} s, {:8.1f} MB by range requests  {}".format(
+            name, data_object.fetch_seconds, data_object.decode_seconds, data_object.bytes_fetched / 1e6,
+            data_object.data_file))
+    print("Read {} files with {} workers in {:.2f} seconds".format(len(data_files), workers, time.time() - start))
+    return data_objects
+
+
+def clone_template(template, analysis_time: datetime.datetime):
+    """Copy of a GRIB template handle with the analysis time of another run"""
+    gh = eccodes.codes_clone(template)
+    eccodes.codes_set_long(gh, "dataDate", int(analysis_time.strftime("%Y%m%d")))
+    eccodes.codes_set_long(gh, "dataTime", int(analysis_time.strftime("%H%M")))
+    return gh
+
+
+def ensemble_product_template(template, percentile: float = None, threshold: float = None,
+                              probability_number: int = 1, probabilities: int = 1):
+    """Copy of a GRIB template handle defining an ensemble percentile or the probability of exceeding threshold (K)
+
+    probability_number (1-based) and probabilities number the thresholds written from the same forecast.
+    """
+    gh = eccodes.codes_clone(template)
+    if percentile is not None:
+        eccodes.codes_set_long(gh, "productDefinitionTemplateNumber", 6)
+        eccodes.codes_set_long(gh, "percentileValue", int(round(percentile)))
+    else:
+        eccodes.codes_set_long(gh, "productDefinitionTemplateNumber", 5)
+        eccodes.codes_set_long(gh, "forecastProbabilityNumber", probability_number)
+        eccodes.codes_set_long(gh, "totalNumberOfForecastProbabilities", probabilities)
+        eccodes.codes_set_long(gh, "probabilityType", 1)  # above upper limit
+        eccodes.codes_set_long(gh, "scaleFactorOfUpperLimit", 2)
+        eccodes.codes_set_long(gh, "scaledValueOfUpperLimit", int(round(threshold * 100)))
+    return gh
+
+
 class WriteData:
     def __init__(self, interpolated_data,
                  input_meta,
                  output_file: str,
                  write_option: str,
                  t_diff: int = 0,
-                 time_series=None):
+                 time_series=None,
+                 packing: str = None,
+                 workers: int = 1,
+                 append: bool = False):
         self.interpolated_data = interpolated_data
         self.t_diff = t_diff
         self.write_option = write_option
         self.template = input_meta
         self.time_series = time_series
+        self.packing = packing
+        self.workers = workers
+        self.append = append
+        self.output_seconds = 0.0
         self.write(output_file)
 
     def write(self, output_file):
         if self.write_option == "s3":
-            openfile = fsspec.open(
-                "simplecache::{}".format(output_file),
-                "wb",
-                s3={
-                    "anon": False,
-                    "key": os.environ["S3_ACCESS_KEY_ID"],
-                    "secret": os.environ["S3_SECRET_ACCESS_KEY"],
-                    "client_kwargs": {"endpoint_url": "https://lake.fmi.fi"},
-                },
-            )
+            # Without a local cache s3fs uploads the file in parts while it is written
+            openfile = fsspec.open(output_file, "wb", s3=s3_write_options())
             with openfile as fpout:
                 self.write_grib_message(fpout)
+                start = time.time()
+            # Closing the file uploads the last part
+            self.output_seconds += time.time() - start
         else:
-            with open(output_file, "wb") as fpout:
+            with open(output_file, "ab" if self.append else "wb") as fpout:
                 self.write_grib_message(fpout)
         print("wrote file '%s'" % output_file)
 
     def write_grib_message(self, fp):
-        dataDate = int(codes_get_long(self.template, "dataDate"))
-        dataTime = int(codes_get_long(self.template, "dataTime"))
+        dataDate = int(eccodes.codes_get_long(self.template, "dataDate"))
+        dataTime = int(eccodes.codes_get_long(self.template, "dataTime"))
         analysistime = datetime.datetime.strptime("{}{:04d}".format(dataDate, dataTime), "%Y%m%d%H%M")
         analysistime = analysistime + datetime.timedelta(hours=self.t_diff)
-        codes_set_long(self.template, "dataDate", int(analysistime.strftime("%Y%m%d")))
-        codes_set_long(self.template, "dataTime", int(analysistime.strftime("%H%M")))
-        codes_set_long(self.template, "bitsPerValue", 24)
-        codes_set_long(self.template, "generatingProcessIdentifier", 202)
-        codes_set_long(self.template, "centre", 86)
-        codes_set_long(self.template, "bitmapPresent", 1)
+        eccodes.codes_set_long(self.template, "dataDate", int(analysistime.strftime("%Y%m%d")))
+        eccodes.codes_set_long(self.template, "dataTime", int(analysistime.strftime("%H%M")))
+        if self.packing is not None:
+            # Repack while the template still holds consistent data values
+            eccodes.codes_set_string(self.template, "packingType", self.packing)
+        eccodes.codes_set_long(self.template, "bitsPerValue", 24)
+        eccodes.codes_set_long(self.template, "generatingProcessIdentifier", 202)
+        eccodes.codes_set_long(self.template, "centre", 86)
+        eccodes.codes_set_long(self.template, "bitmapPresent", 1)
 
         # Specify railtrack specific metadata
-        codes_set_long(self.template, "parameterNumber", 195)
-        codes_set_long(self.template, "generatingProcessIdentifier", 240)
+        eccodes.codes_set_long(self.template, "parameterNumber", 195)
+        eccodes.codes_set_long(self.template, "generatingProcessIdentifier", 240)
 
-        codes_set_long(self.template, "indicatorOfUnitOfTimeRange", 0)  # minute
-        codes_set_long(self.template, "stepUnits", 1)  # minute
+        eccodes.codes_set_long(self.template, "indicatorOfUnitOfTimeRange", 0)  # minute
+        eccodes.codes_set_long(self.template, "stepUnits", 0)  # minute
         base_lt = datetime.timedelta(minutes=15)
-        pdtn = codes_get_long(self.template, "productDefinitionTemplateNumber")
-        for i in range(self.interpolated_data.shape[0]):
-            lt = base_lt * i
-            if self.time_series is not None:
-                lt = self.time_series[i] - self.time_series[0]
-            if pdtn == 8:
-                lt -= base_lt
-
-                tr = codes_get_long(self.template, "indicatorOfUnitForTimeRange")
-                trlen = codes_get_long(self.template, "lengthOfTimeRange")
-
-                assert ((tr == 1 and trlen == 1) or (tr == 0 and trlen == 60))
-                lt_end = analysistime + datetime.timedelta(
-                    hours=codes_get_long(self.template, "lengthOfTimeRange"))
-
-                # these are not mandatory but some software uses them
-                codes_set_long(self.template, "yearOfEndOfOverallTimeInterval", int(lt_end.strftime("%Y")))
-                codes_set_long(self.template, "monthOfEndOfOverallTimeInterval", int(lt_end.strftime("%m")))
-                codes_set_long(self.template, "dayOfEndOfOverallTimeInterval", int(lt_end.strftime("%d")))
-                codes_set_long(self.template, "hourOfEndOfOverallTimeInterval", int(lt_end.strftime("%H")))
-                codes_set_long(self.template, "minuteOfEndOfOverallTimeInterval", int(lt_end.strftime("%M")))
-                codes_set_long(self.template, "secondOfEndOfOverallTimeInterval", int(lt_end.strftime("%S")))
-
-            codes_set_long(self.template, "forecastTime", lt.total_seconds() / 60)
-            codes_set_values(self.template, self.interpolated_data[i, :, :].flatten())
-            codes_write(self.template, fp)
+        pdtn = eccodes.codes_get_long(self.template, "productDefinitionTemplateNumber")
+        if pdtn == 8:
+            tr = eccodes.codes_get_long(self.template, "indicatorOfUnitForTimeRange")
+            trlen = eccodes.codes_get_long(self.template, "lengthOfTimeRange")
+
+            assert ((tr == 1 and trlen == 1) or (tr == 0 and trlen == 60))
+            lt_end = analysistime + datetime.timedelta(
+                hours=eccodes.codes_get_long(self.template, "lengthOfTimeRange"))
+
+            # these are not mandatory but some software uses them
+            eccodes.codes_set_long(self.template, "yearOfEndOfOverallTimeInterval", int(lt_end.strftime("%Y")))
+            eccodes.codes_set_long(self.template, "monthOfEndOfOverallTimeInterval", int(lt_end.strftime("%m")))
+            eccodes.codes_set_long(self.template, "dayOfEndOfOverallTimeInterval", int(lt_end.strftime("%d")))
+            eccodes.codes_set_long(self.template, "hourOfEndOfOverallTimeInterval", int(lt_end.strftime("%H")))
+            eccodes.codes_set_long(self.template, "minuteOfEndOfOverallTimeInterval", int(lt_end.strftime("%M")))
+            eccodes.codes_set_long(self.template, "secondOfEndOfOverallTimeInterval", int(lt_end.strftime("%S")))
+
+        def message_handles():
+            # interpolated_data may also be an iterator yielding the 2-D fields one step at a time
+            for i, values in enumerate(self.interpolated_data):
+                lt = base_lt * i
+                if self.time_series is not None:
+                    # Lead times are counted from the analysis time like in the input files
+                    lt = self.time_series[i] - analysistime
+                if pdtn == 8:
+                    lt -= base_lt
+                yield self.template, lt.total_seconds() / 60, values
+
+        # Messages are cloned from the template and encoded concurrently but written in order
+        for message in ordered_parallel_map(encode_grib_message, message_handles(), self.workers):
+            start = time.time()
+            fp.write(message)
+            self.output_seconds += time.time() - start
 
         print("")
-        codes_release(self.template)
+        eccodes.codes_release(self.template)
         #fp.close()
+
+
+def s3_write_options() -> dict:
+    return {"anon": False,
+            "key": os.environ["S3_ACCESS_KEY_ID"],
+            "secret": os.environ["S3_SECRET_ACCESS_KEY"],
+            "client_kwargs": {"endpoint_url": os.environ.get("S3_ENDPOINT_URL", "https://lake.fmi.fi")}}
+
+
+def encode_grib_message(template, forecast_time, values) -> bytes:
+    gh = eccodes.codes_clone(template)
+    eccodes.codes_set_long(gh, "forecastTime", forecast_time)
+    eccodes.codes_set_values(gh, np.ravel(values))
+    message = eccodes.codes_get_message(gh)
+    eccodes.codes_release(gh)
+    return message
+
+
+def ordered_parallel_map(func, items, workers: int):
+    """Apply func to argument tuples in a thread pool and yield the results in order
+
+    At most 2 * workers items are in flight, so an iterator of items is consumed lazily.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(func, *item))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
@@ -1,6 +1,27 @@
+import time
+# Startup time of the imports below, see --profile_import
+IMPORT_START = time.perf_counter()
+import os
+import sys
 import argparse
+import datetime
+import tempfile
+import numpy as np
 import tools as tl
-from file_utils import ReadData, WriteData
+import features as ft
+import ml_backends
+import instrumentation as instr
+import incremental
+import feature_store
+import output_formats
+import lazy_imports
+from concurrent.futures import ThreadPoolExecutor
+from file_utils import ReadData, WriteData, read_data_concurrently, configure_grid_cache, s3_write_options, \
+    ensemble_product_template
+
+eccodes = lazy_imports.lazy_import("eccodes")
+fsspec = lazy_imports.lazy_import("fsspec")
+IMPORT_SECONDS = time.perf_counter() - IMPORT_START
 
 
 def main():
@@ -9,52 +30,422 @@ def main():
     This program creates...
 
     """
-    data, data_meta, ds = [], [], []
     args = parse_command_line()
+    profiler = instr.start_profiler(args.profile, args.profile_file)
+    if args.cache_dir is not None:
+        tl.configure_file_cache(args.cache_dir, args.cache_size_gb)
+        configure_grid_cache(os.path.join(args.cache_dir, "grids"))
+    if args.from_feature_store is not None:
+        run_from_feature_store(args)
+    elif args.incremental:
+        run_incremental(args)
+    elif args.streaming:
+        run_streaming(args)
+    else:
+        run(args)
+    if tl.FILE_CACHE is not None:
+        tl.FILE_CACHE.report()
+    if profiler is not None:
+        profiler.stop()
+    instr.RECORDER.report()
+    if args.metrics_file is not None:
+        instr.RECORDER.write(args.metrics_file)
+    if args.profile_import:
+        lazy_imports.import_report(IMPORT_SECONDS, args.import_budget)
+
+
+def run(args):
     forecast_params = tl.fetch_basic_predictor_files(args)
-    for i, (param_name, param_file) in enumerate(forecast_params.items()):
-        if param_name == 'SKT':
-            data_meta = ReadData(param_file, use_as_template=True, read_coordinates=True)
+    with instr.stage("fetch"):
+        if not args.byte_range:
+            forecast_params = fetch_input_files(forecast_params, args.workers)
+        ML_model = tl.load_ML_model(args.ML_model, args.ML_backend)
+    with instr.stage("decode"):
+        predictors = read_predictors(forecast_params, args)
+    data_meta = predictors.pop('template')
+    forecast(predictors, data_meta.template, ML_model, args.output_file, args)
+
+
+def fetch_input_files(data_files: dict, workers: int = 4) -> dict:
+    """Local copies of S3 input files, downloaded concurrently"""
+    def fetch(data_file):
+        return tl.read_file_from_s3(data_file) if data_file.startswith("s3://") else data_file
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(data_files, executor.map(fetch, data_files.values())))
+
+
+def read_predictors(forecast_params: dict, args, read_template: bool = True, read_coordinates: bool = True) -> dict:
+    data_files = dict(forecast_params)
+    members = None
+    if args.ensemble:
+        # Every member of every input is decoded into one (member, time, y, x) array
+        members = ReadData.open(forecast_params['T2'], byte_range=args.byte_range).members
+        print("Ensemble of {} members".format(len(members)))
+    read_options = {name: dict(time_steps=125, preallocate=args.preallocate, scratch_dir=args.scratch_dir,
+                               dtype=args.dtype, members=members, byte_range=args.byte_range)
+                    for name in forecast_params}
+    read_options['T2']['read_coordinates'] = read_coordinates
+    read_options['SRR1h']['missing_data'] = True
+    read_options['STR1h']['missing_data'] = True
+    # Differences of large radiation accumulations lose precision in float32
+    read_options['SRR1h']['dtype'] = 'float64'
+    read_options['STR1h']['dtype'] = 'float64'
+    if read_template:
+        data_files['template'] = forecast_params['SKT']
+        read_options['template'] = dict(use_as_template=True, read_coordinates=True, dtype=args.dtype,
+                                        members=members[:1] if members is not None else None,
+                                        byte_range=args.byte_range)
+    return read_data_concurrently(data_files, read_options, workers=args.workers)
+
+
+def build_dataset(predictors: dict):
+    ds = []
+    for i, (param_name, data) in enumerate(predictors.items()):
         if i == 0:
-            data = ReadData(param_file, read_coordinates=True, time_steps=125)
-            data = tl.mask_missing_data(data)
             ds = tl.create_dataset(data, param_name)
             ds = tl.calculate_forecast_period_dataset(data.dtime, ds)
             continue
         if param_name == 'SRR1h' or param_name == 'STR1h':
-            data_rad = ReadData(param_file, time_steps=125, missing_data=True)
-            data_rad = tl.mask_missing_data(data_rad)
             #TODO: tarkasta toimiiko maskin kanssa
-            ds = tl.calculate_hourly_values_dataset(data_rad.data, param_name, ds)
+            ds = tl.calculate_hourly_values_dataset(data.data, param_name, ds)
             continue
-        data = ReadData(param_file, time_steps=125)
-        data = tl.mask_missing_data(data)
         ds = tl.add_data_to_dataset(data, param_name, ds)
+    data = predictors['T2']
     ds = tl.calculate_angle_time_dataset(data.dtime, ds)
     ds = tl.convert_percentage_to_zero_one(['LCC', 'MCC'], ds)
-    ML_model = tl.load_ML_model(args.ML_model)
-    t_trail_fcst = tl.generate_ML_forecast_domain(ds, ML_model, data.data[1:])
-    WriteData(t_trail_fcst, data_meta.template, args.output_file,
-              's3' if args.output_file.startswith('s3://') else 'local',
-              time_series=data.dtime[1:])
+    return ds
+
+
+def build_features(predictors: dict) -> dict:
+    """Model features of the forecast steps as plain NumPy arrays keyed like the variables of build_dataset()
+
+    Same values as build_dataset() without constructing an xr.Dataset, for runs that
+    do not save a feature store.
+    """
+    data = predictors['T2']
+    shape = data.data[..., 1:, :, :].shape
+    axis = len(shape) - 3
+    period = ft.forecast_period_hours(data.dtime).astype(data.data.dtype)
+    features = {'lat': data.latitudes, 'lon': data.longitudes,
+                'forecast_period': ft.broadcast_over_domain(period[1:], shape, axis)}
+    for param_name, param_data in predictors.items():
+        if param_name == 'SRR1h' or param_name == 'STR1h':
+            features[param_name] = ft.hourly_values(param_data.data, period[1:], dtype=data.data.dtype, axis=axis)
+        elif param_name == 'LCC' or param_name == 'MCC':
+            features[param_name] = param_data.data[..., 1:, :, :] / 100
+        else:
+            features[param_name] = param_data.data[..., 1:, :, :]
+    for key, values in ft.time_angle_features(data.dtime).items():
+        features[key] = ft.broadcast_over_domain(values[1:].astype(data.data.dtype), shape, axis)
+    return features
+
+
+def forecast(predictors: dict, template, model, output_file: str, args):
+    """Predict the railtrack temperature from read predictors and write it to output_file
+
+    The GRIB template handle is released after writing.
+    """
+    with instr.stage("masking"):
+        for data in predictors.values():
+            tl.mask_missing_data(data)
+    with instr.stage("features"):
+        # The xr.Dataset is only needed to save the feature store
+        ds = build_features(predictors) if args.feature_store is None else build_dataset(predictors)
+    data = predictors['T2']
+    if args.feature_store is not None:
+        with instr.stage("feature_store"):
+            feature_store.write_feature_store(ds, template, args.feature_store, data.analysis_time,
+                                              chunk_size=args.chunk_size, tile_size=args.tile_size)
+    predict_and_write(ds, template, model, output_file, data.dtime[1:], args)
+
+
+def predict_and_write(ds, template, model, output_file: str, times, args):
+    """Predict the railtrack temperature of the features in ds and write it to output_file
+
+    Features of an ensemble have a member dimension, then the ensemble percentiles
+    and exceedance probabilities are written instead, see ensemble_output_file().
+    """
+    if args.track_points is not None:
+        with instr.stage("inference"):
+            points, indices, weights = tl.load_track_point_weights(args.track_points, np.asarray(ds['lat']), np.asarray(ds['lon']))
+            t_trail_fcst = tl.generate_ML_forecast_track_points(ds, model, indices, weights)
+        with instr.stage("write"), ThreadPoolExecutor(max_workers=len(args.output_formats) or 1) as executor:
+            futures = output_formats.write_point_outputs(points, times, t_trail_fcst, output_file,
+                                                         args.output_formats, executor)
+            tl.write_track_point_forecast(points, times, t_trail_fcst, output_file)
+            for future in futures:
+                future.result()
+        eccodes.codes_release(template)
+        return
+    with instr.stage("inference"):
+        t_trail_fcst = tl.generate_ML_forecast_domain(ds, model, ds['T2'], chunk_size=args.chunk_size,
+                                                      workers=args.inference_workers, tile_size=args.tile_size)
+    latitudes, longitudes = np.asarray(ds['lat']), np.asarray(ds['lon'])
+    if np.ndim(ds['T2']) == 4:
+        write_ensemble_products(t_trail_fcst, template, output_file, times, latitudes, longitudes, args)
+        return
+    with instr.stage("write") as record, ThreadPoolExecutor(max_workers=len(args.output_formats) or 1) as executor:
+        futures = output_formats.write_outputs(t_trail_fcst, times, latitudes, longitudes, output_file,
+                                               args.output_formats, executor)
+        writer = WriteData(t_trail_fcst, template, output_file,
+                           's3' if output_file.startswith('s3://') else 'local',
+                           time_series=times, packing=args.packing, workers=args.encode_workers)
+        record['output_seconds'] = writer.output_seconds
+        for future in futures:
+            future.result()
+
+
+def write_ensemble_products(t_trail_fcst, template, output_file: str, times, latitudes, longitudes, args):
+    """Write percentiles and exceedance probabilities of a (member, time, y, x) forecast, one file each"""
+    with instr.stage("ensemble_products"):
+        thresholds = np.asarray(args.exceedance_thresholds, dtype=float) + 273.15
+        quantiles, probabilities = tl.ensemble_products(t_trail_fcst, args.percentiles, thresholds)
+    products = [(ensemble_product_template(template, percentile=percentile), values,
+                 ensemble_output_file(output_file, "p{:g}".format(percentile)), 'K')
+                for percentile, values in zip(args.percentiles, quantiles)]
+    products += [(ensemble_product_template(template, threshold=threshold + 273.15, probability_number=number,
+                                            probabilities=len(args.exceedance_thresholds)), values,
+                  ensemble_output_file(output_file, "exceed{:g}C".format(threshold)), '%')
+                 for number, (threshold, values) in enumerate(zip(args.exceedance_thresholds, probabilities), 1)]
+    eccodes.codes_release(template)
+    with instr.stage("write") as record, ThreadPoolExecutor(max_workers=len(args.output_formats) or 1) as executor:
+        futures = []
+        for product_template, values, product_file, units in products:
+            futures += output_formats.write_outputs(values, times, latitudes, longitudes, product_file,
+                                                    args.output_formats, executor, units=units)
+            writer = WriteData(values, product_template, product_file,
+                               's3' if product_file.startswith('s3://') else 'local',
+                               time_series=times, packing=args.packing, workers=args.encode_workers)
+            record['output_seconds'] = record.get('output_seconds', 0.0) + writer.output_seconds
+        for future in futures:
+            future.result()
+
+
+def ensemble_output_file(output_file: str, product: str) -> str:
+    """Output file of an ensemble product, e.g. fcst_p90.grib2 or fcst_exceed40C.grib2 for fcst.grib2"""
+    root, extension = os.path.splitext(output_file)
+    return "{}_{}{}".format(root, product, extension)
+
+
+def run_from_feature_store(args):
+    """Rerun inference and writing from a feature store without reading any GRIB input"""
+    with instr.stage("fetch"):
+        ds, template = feature_store.open_feature_store(args.from_feature_store)
+        ML_model = tl.load_ML_model(args.ML_model, args.ML_backend)
+    predict_and_write(ds, template, ML_model, args.output_file, ds.indexes['time'].to_pydatetime(), args)
+
+
+def run_streaming(args, time_steps=125):
+    """Process one lead time at a time from reading to writing the output message"""
+    forecast_params = tl.fetch_basic_predictor_files(args)
+    with instr.stage("fetch"):
+        if not args.byte_range:
+            forecast_params = fetch_input_files(forecast_params, args.workers)
+        ML_model = tl.load_ML_model(args.ML_model, args.ML_backend)
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        dtypes = ['float64' if name in ('SRR1h', 'STR1h') else args.dtype for name in forecast_params]
+        grib_files = dict(zip(forecast_params, executor.map(
+            lambda data_file, dtype: ReadData.open(data_file, dtype=dtype, byte_range=args.byte_range),
+            forecast_params.values(), dtypes)))
+    leadtimes = grib_files['T2'].leadtimes[:time_steps + 1]
+    for param_name, grib_file in grib_files.items():
+        if grib_file.leadtimes[:time_steps + 1] != leadtimes:
+            sys.exit("Lead times of {} differ from T2".format(param_name))
+    times = np.array([grib_files['T2'].analysis_time + lt for lt in leadtimes])
+    data_meta = ReadData(forecast_params['SKT'], use_as_template=True, read_coordinates=True,
+                         byte_range=args.byte_range)
+    # Decoding, inference and encoding are interleaved one lead time at a time
+    with instr.stage("stream") as record:
+        t_trail_fcst = tl.generate_ML_forecast_stream(grib_files, ML_model, times)
+        writer = WriteData(t_trail_fcst, data_meta.template, args.output_file,
+                           's3' if args.output_file.startswith('s3://') else 'local',
+                           time_series=times[1:], packing=args.packing, workers=args.encode_workers)
+        record['output_seconds'] = writer.output_seconds
+
+
+def run_incremental(args, time_steps=125):
+    """Forecast lead times as soon as every input file contains them
+
+    The growing input files are polled; new steps are predicted one at a time and
+    appended to the output, which is re-published after every batch when it goes to
+    S3. The progress and the last radiation accumulations are saved to a state file,
+    so an interrupted run continues from the last written step.
+    """
+    forecast_params = tl.fetch_basic_predictor_files(args)
+    if tl.FILE_CACHE is None and any(f.startswith("s3://") for f in forecast_params.values()):
+        # The file cache notices new versions of the S3 objects by their ETag
+        tl.configure_file_cache(os.path.join(tempfile.gettempdir(), "railtrack_cache"), args.cache_size_gb)
+    ML_model = tl.load_ML_model(args.ML_model, args.ML_backend)
+    output_file = args.output_file
+    if output_file.startswith("s3://"):
+        output_file = os.path.join(args.scratch_dir or tempfile.gettempdir(), os.path.basename(args.output_file))
+    final_leadtime = datetime.timedelta(hours=args.final_leadtime)
+    deadline = time.time() + args.max_wait_minutes * 60
+    state, template = None, None
+    while True:
+        with instr.stage("fetch"):
+            local_files = fetch_input_files(forecast_params, args.workers)
+        dtypes = ['float64' if name in ('SRR1h', 'STR1h') else args.dtype for name in local_files]
+        grib_files = {name: ReadData.open(data_file, dtype=dtype)
+                      for (name, data_file), dtype in zip(local_files.items(), dtypes)}
+        times = incremental.available_times(grib_files, time_steps)
+        if len(times) > 1:
+            if state is None:
+                state = incremental.IncrementalState.load(output_file + ".state.npz", times[0])
+                if not os.path.exists(output_file) or os.path.getsize(output_file) < state.output_size:
+                    state = incremental.IncrementalState(output_file + ".state.npz", times[0])
+                incremental.prepare_output(output_file, state.output_size)
+                template = ReadData(local_files['SKT'], use_as_template=True,
+                                    leadtimes=[grib_files['SKT'].leadtimes[0]]).template
+            if len(times) - 1 > state.last_step:
+                start = state.last_step + 1
+                with instr.stage("stream", first_step=str(start), last_step=str(len(times) - 1)):
+                    t_trail_fcst = tl.generate_ML_forecast_stream(grib_files, ML_model, times, start=start,
+                                                                  previous=state.previous)
+                    WriteData(t_trail_fcst, eccodes.codes_clone(template), output_file, 'local',
+                              time_series=times[start:], packing=args.packing, workers=args.encode_workers,
+                              append=True)
+                state.last_step = len(times) - 1
+                state.output_size = os.path.getsize(output_file)
+                state.save()
+                if args.output_file.startswith("s3://"):
+                    with instr.stage("upload"):
+                        fsspec.filesystem("s3", **s3_write_options()).put_file(output_file, args.output_file)
+                print("Forecast written up to {} ({} steps)".format(times[-1], state.last_step))
+            if times[-1] - times[0] >= final_leadtime:
+                break
+        if time.time() > deadline:
+            sys.exit("Input files not complete up to {} in {} minutes".format(final_leadtime, args.max_wait_minutes))
+        time.sleep(args.poll_seconds)
+    eccodes.codes_release(template)
 
 
 def parse_command_line():
     parser = argparse.ArgumentParser(argument_default=None)
-    parser.add_argument("--T2", action="store", type=str, required=True)
-    parser.add_argument("--D2", action="store", type=str, required=True)
-    parser.add_argument("--SKT", action="store", type=str, required=True)
-    parser.add_argument("--T_925", action="store", type=str, required=True)
-    parser.add_argument("--WS", action="store", type=str, required=True)
-    parser.add_argument("--LCC", action="store", type=str, required=True)
-    parser.add_argument("--MCC", action="store", type=str, required=True)
-    parser.add_argument("--SRR1h", action="store", type=str, required=True)
-    parser.add_argument("--STR1h", action="store", type=str, required=True)
+    parser.add_argument("--T2", action="store", type=str)
+    parser.add_argument("--D2", action="store", type=str)
+    parser.add_argument("--SKT", action="store", type=str)
+    parser.add_argument("--T_925", action="store", type=str)
+    parser.add_argument("--WS", action="store", type=str)
+    parser.add_argument("--LCC", action="store", type=str)
+    parser.add_argument("--MCC", action="store", type=str)
+    parser.add_argument("--SRR1h", action="store", type=str)
+    parser.add_argument("--STR1h", action="store", type=str)
     parser.add_argument("--ML_model", action="store", type=str, required=True)
     parser.add_argument("--output_file", action="store", type=str, required=True)
+    parser.add_argument("--from_feature_store", action="store", type=str, default=None,
+                        help="Predict from a Zarr feature store written with --feature_store instead of GRIB input")
+    parser.add_argument("--profile_import", action="store_true", default=False,
+                        help="Report the startup import time and the time of every library imported on first use")
+    parser.add_argument("--import_budget", action="store", type=float, default=None,
+                        help="Warn in the --profile_import report if the startup imports take longer (seconds)")
+    parser.add_argument("--streaming", action="store_true", default=False,
+                        help="Read, predict and write one lead time at a time to keep memory use O(grid)")
+    parser.add_argument("--incremental", action="store_true", default=False,
+                        help="Poll growing input files and append forecast steps as soon as they are available")
+    parser.add_argument("--poll_seconds", action="store", type=float, default=30,
+                        help="Interval of checking the input files in incremental mode")
+    parser.add_argument("--final_leadtime", action="store", type=int, default=240,
+                        help="Lead time in hours after which the incremental forecast is complete")
+    parser.add_argument("--max_wait_minutes", action="store", type=float, default=360,
+                        help="Give up the incremental forecast if the input is not complete in this time")
+    add_processing_arguments(parser)
     args = parser.parse_args()
+    missing = [name for name, data_file in tl.fetch_basic_predictor_files(args).items() if data_file is None]
+    if args.from_feature_store is None and missing:
+        parser.error("the following arguments are required: {}".format(", ".join("--" + name for name in missing)))
+    if args.ensemble and (args.streaming or args.incremental):
+        parser.error("--ensemble can not be combined with --streaming or --incremental")
+    if args.byte_range and args.incremental:
+        parser.error("--byte_range can not be combined with --incremental")
+    if args.output_formats and (args.streaming or args.incremental):
+        parser.error("--output_formats can not be combined with --streaming or --incremental")
+    check_track_point_output(parser, args, args.output_file, "--output_file")
+    check_processing_arguments(parser, args)
     return args
 
 
+def check_track_point_output(parser, args, output_file: str, option: str):
+    """The table of --track_points is written as CSV or Parquet by the extension of output_file"""
+    if args.track_points is None:
+        return
+    table_format = tl.track_point_format(output_file)
+    if table_format is None:
+        parser.error("{} of --track_points must have one of the extensions {}".format(
+            option, ", ".join(tl.TRACK_POINT_FORMATS)))
+    if table_format == 'parquet' and 'parquet' in args.output_formats:
+        parser.error("{} is already the Parquet table of --track_points".format(option))
+    missing = output_formats.missing_packages(table_format) if table_format in output_formats.FORMAT_PACKAGES else []
+    if missing:
+        parser.error("{} needs one of the packages {}".format(option, ", ".join(missing)))
+
+
+def check_processing_arguments(parser, args):
+    if args.ensemble and args.track_points is not None:
+        parser.error("--ensemble can not be combined with --track_points")
+    grid_formats = [f for f in args.output_formats if f in output_formats.GRID_FORMATS]
+    if grid_formats and args.track_points is not None:
+        parser.error("--output_formats {} can not be combined with --track_points".format(" ".join(grid_formats)))
+    if 'parquet' in args.output_formats and args.track_points is None:
+        parser.error("--output_formats parquet writes the point values of --track_points")
+    for output_format in args.output_formats:
+        missing = output_formats.missing_packages(output_format)
+        if missing:
+            parser.error("--output_formats {} needs one of the packages {}".format(output_format, ", ".join(missing)))
+
+
+def add_processing_arguments(parser):
+    parser.add_argument("--ML_backend", action="store", type=str, default="joblib", choices=ml_backends.BACKENDS,
+                        help="Inference backend of --ML_model, converted models are made with ml_backends.py")
+    parser.add_argument("--feature_store", action="store", type=str, default=None,
+                        help="Also save the model features as a Zarr store per analysis time in this directory or S3 prefix")
+    parser.add_argument("--track_points", action="store", type=str, default=None,
+                        help="Predict only at rail network points (CSV or GeoJSON) and write a table, "
+                             "CSV or Parquet by the .csv/.parquet extension of the output file")
+    parser.add_argument("--chunk_size", action="store", type=int, default=tl.INFERENCE_CHUNK_SIZE,
+                        help="Maximum number of grid points x time steps predicted in one model call")
+    parser.add_argument("--inference_workers", action="store", type=int, default=1,
+                        help="Number of tiles predicted concurrently")
+    parser.add_argument("--tile_size", action="store", type=int, default=None,
+                        help="Number of grid rows in an inference tile, whole domain by default")
+    parser.add_argument("--workers", action="store", type=int, default=4,
+                        help="Number of input files fetched and decoded concurrently")
+    parser.add_argument("--encode_workers", action="store", type=int, default=4,
+                        help="Number of output GRIB messages encoded concurrently")
+    parser.add_argument("--packing", action="store", type=str, default=None, choices=["grid_simple", "grid_ccsds"],
+                        help="Packing of output GRIB messages, same as the input template by default")
+    parser.add_argument("--ensemble", action="store_true", default=False,
+                        help="Predict every member of ensemble input and write percentiles and exceedance probabilities")
+    parser.add_argument("--percentiles", action="store", type=float, nargs="+", default=[10, 50, 90],
+                        help="Percentiles of the ensemble forecast written in --ensemble mode")
+    parser.add_argument("--exceedance_thresholds", action="store", type=float, nargs="*", default=[],
+                        help="Rail temperatures (C) whose ensemble exceedance probability is written in --ensemble mode")
+    parser.add_argument("--output_formats", action="store", type=str, nargs="*", default=[],
+                        choices=list(output_formats.OUTPUT_FORMATS),
+                        help="Also write the forecast grid as Zarr or NetCDF4 next to the GRIB2 output, e.g. "
+                             "fcst.zarr for fcst.grib2, or the --track_points values as Parquet")
+    parser.add_argument("--byte_range", action="store_true", default=False,
+                        help="Fetch only the decoded messages of S3 input files with range requests instead of "
+                             "downloading them, see remote_grib.py")
+    parser.add_argument("--dtype", action="store", type=str, default="float32", choices=["float32", "float64"],
+                        help="Floating point type of decoded input data and features")
+    parser.add_argument("--preallocate", action="store_true", default=False,
+                        help="Decode input data into preallocated arrays")
+    parser.add_argument("--scratch_dir", action="store", type=str, default=None,
+                        help="Memory-map preallocated input arrays to files in this directory, "
+                             "also holds the local copy of an incremental S3 output")
+    parser.add_argument("--cache_dir", action="store", type=str, default=os.environ.get("RAILTRACK_CACHE_DIR"),
+                        help="Persistent cache directory for S3 input files and the ML model")
+    parser.add_argument("--cache_size_gb", action="store", type=float, default=None,
+                        help="Evict least recently used files when the cache grows over this size")
+    parser.add_argument("--metrics_file", action="store", type=str, default=None,
+                        help="Write timing, I/O and memory of each stage as JSON lines, or a Prometheus textfile (.prom)")
+    parser.add_argument("--profile", action="store", type=str, default=None, choices=["cprofile", "py-spy"],
+                        help="Profile the run with cProfile (main thread) or py-spy (all threads)")
+    parser.add_argument("--profile_file", action="store", type=str, default=None,
+                        help="Profiler output, railtrack.prof or railtrack.svg by default")
+
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,70 @@
+import os
+import datetime
+import numpy as np
+
+
+class IncrementalState:
+    """Progress of an incremental forecast, saved after every written batch of steps
+
+    last_step is the index of the last forecast time written (0 = nothing written),
+    output_size the length of the output file after it and previous the radiation
+    accumulations of last_step, which the next step is de-accumulated against.
+    """
+    def __init__(self, state_file: str, analysis_time: datetime.datetime):
+        self.state_file = state_file
+        self.analysis_time = analysis_time
+        self.last_step = 0
+        self.output_size = 0
+        self.previous = {}
+
+    @classmethod
+    def load(cls, state_file: str, analysis_time: datetime.datetime):
+        """State of an interrupted run of the same analysis time, or a fresh state"""
+        state = cls(state_file, analysis_time)
+        try:
+            with np.load(state_file) as saved:
+                if str(saved['analysis_time']) != analysis_time.isoformat():
+                    return state
+                state.last_step = int(saved['last_step'])
+                state.output_size = int(saved['output_size'])
+                state.previous = {key[len('previous_'):]: saved[key] for key in saved.files
+                                  if key.startswith('previous_')}
+        except (OSError, KeyError, ValueError):
+            return state
+        print("Resuming {} after step {}".format(analysis_time, state.last_step))
+        return state
+
+    def save(self):
+        tmp_file = "{}.{}.tmp.npz".format(self.state_file, os.getpid())
+        np.savez(tmp_file, analysis_time=self.analysis_time.isoformat(), last_step=self.last_step,
+                 output_size=self.output_size, **{'previous_' + key: value for key, value in self.previous.items()})
+        os.replace(tmp_file, self.state_file)
+
+
+def available_times(grib_files: dict, time_steps: int) -> np.ndarray:
+    """Forecast times, from the analysis time on, of which every input file has a complete message
+
+    Only the leading lead times common to all files count, so a gap in one file
+    holds back the later steps.
+    """
+    leadtimes = None
+    for grib_file in grib_files.values():
+        file_leadtimes = grib_file.leadtimes[:time_steps + 1]
+        if leadtimes is None:
+            leadtimes = file_leadtimes
+            continue
+        common = 0
+        while common < min(len(leadtimes), len(file_leadtimes)) and leadtimes[common] == file_leadtimes[common]:
+            common += 1
+        leadtimes = leadtimes[:common]
+    if not leadtimes:
+        return np.array([], dtype=object)
+    analysis_time = grib_files['T2'].analysis_time
+    return np.array([analysis_time + lt for lt in leadtimes])
+
+
+def prepare_output(output_file: str, output_size: int):
+    """Cut a partly appended output file back to the size recorded in the state"""
+    mode = "r+b" if os.path.exists(output_file) else "wb"
+    with open(output_file, mode) as fp:
+        fp.truncate(output_size)
@@ -0,0 +1,146 @@
+import os
+import sys
+import json
+import time
+import signal
+import resource
+import datetime
+import subprocess
+from contextlib import contextmanager
+
+
+def read_io_counters() -> dict:
+    """Bytes read and written by the process so far, including network and page cache I/O (Linux only)"""
+    counters = {}
+    try:
+        with open("/proc/self/io") as fp:
+            for line in fp:
+                key, value = line.split(":")
+                counters[key] = int(value)
+    except OSError:
+        return {'rchar': 0, 'wchar': 0}
+    return counters
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class StageRecorder:
+    """Records wall time, CPU time, bytes read/written and peak RSS of pipeline stages
+
+    CPU time and I/O counters are process wide, so stages running concurrently
+    (e.g. prefetching the next run in batch mode) are included in each other.
+    """
+    def __init__(self):
+        self.records = []
+        self.labels = {}
+
+    @contextmanager
+    def stage(self, name: str, **labels):
+        io_start = read_io_counters()
+        cpu_start = time.process_time()
+        start = time.perf_counter()
+        record = {'stage': name, **self.labels, **labels}
+        try:
+            yield record
+        finally:
+            io_end = read_io_counters()
+            record.update({'wall_seconds': time.perf_counter() - start,
+                           'cpu_seconds': time.process_time() - cpu_start,
+                           'bytes_read': io_end['rchar'] - io_start['rchar'],
+                           'bytes_written': io_end['wchar'] - io_start['wchar'],
+                           'peak_rss_mb': peak_rss_mb(),
+                           'end_time': datetime.datetime.now(datetime.timezone.utc).isoformat()})
+            self.records.append(record)
+
+    def report(self):
+        for record in self.records:
+            print("{:<10s} wall {:7.2f} s, cpu {:7.2f} s, read {:8.1f} MB, written {:8.1f} MB, peak RSS {:8.1f} MB".format(
+                record['stage'], record['wall_seconds'], record['cpu_seconds'], record['bytes_read'] / 1e6,
+                record['bytes_written'] / 1e6, record['peak_rss_mb']))
+
+    def write(self, output_file: str):
+        """Write the records as JSON lines, or as a Prometheus textfile if output_file ends with .prom"""
+        if output_file.endswith(".prom"):
+            content = self.prometheus_text()
+        else:
+            content = "".join(json.dumps(record) + "\n" for record in self.records)
+        # The textfile collector must never see a partly written file
+        tmp_file = output_file + ".tmp"
+        with open(tmp_file, "w") as fp:
+            fp.write(content)
+        os.replace(tmp_file, output_file)
+        print("wrote file '%s'" % output_file)
+
+    def prometheus_text(self) -> str:
+        descriptions = {'wall_seconds': "Wall time of the forecast stage",
+                        'cpu_seconds': "Process CPU time during the forecast stage",
+                        'bytes_read': "Bytes read by the process during the forecast stage",
+                        'bytes_written': "Bytes written by the process during the forecast stage",
+                        'peak_rss_mb': "Peak resident set size of the process at the end of the stage"}
+        # String fields of the records are labels, numeric fields are metrics
+        metrics = list(descriptions) + sorted({key for record in self.records for key, value in record.items()
+                                               if isinstance(value, (int, float)) and key not in descriptions})
+        lines = []
+        for metric in metrics:
+            name = "railtrack_stage_{}".format(metric)
+            lines.append("# HELP {} {}".format(name, descriptions.get(metric, metric.replace("_", " "))))
+            lines.append("# TYPE {} gauge".format(name))
+            values = {}
+            for record in self.records:
+                if metric not in record:
+                    continue
+                key = ",".join('{}="{}"'.format(k, v) for k, v in record.items()
+                               if isinstance(v, str) and k != 'end_time')
+                # Repeated stages of the same labels are summed, the peak RSS is the maximum
+                combine = max if metric == 'peak_rss_mb' else lambda a, b: a + b
+                values[key] = combine(values[key], record[metric]) if key in values else record[metric]
+            lines.extend("{}{{{}}} {}".format(name, key, value) for key, value in values.items())
+        return "\n".join(lines) + "\n"
+
+
+# Recorder of the running forecast, stages are recorded with instrumentation.stage("name")
+RECORDER = StageRecorder()
+
+
+def stage(name: str, **labels):
+    return RECORDER.stage(name, **labels)
+
+
+class Profiler:
+    """cProfile of the main thread or a py-spy sampling profile of all threads of the process"""
+    def __init__(self, kind: str, output_file: str):
+        self.kind = kind
+        self.output_file = output_file
+        if kind == "cprofile":
+            import cProfile
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        elif kind == "py-spy":
+            try:
+                self.process = subprocess.Popen(["py-spy", "record", "--pid", str(os.getpid()), "--threads",
+                                                 "--output", output_file])
+            except FileNotFoundError:
+                sys.exit("py-spy is not installed")
+        else:
+            raise ValueError("Unknown profiler: {}".format(kind))
+
+    def stop(self):
+        if self.kind == "cprofile":
+            self.profile.disable()
+            self.profile.dump_stats(self.output_file)
+        else:
+            # py-spy writes its output when interrupted
+            self.process.send_signal(signal.SIGINT)
+            self.process.wait()
+        print("wrote file '%s'" % self.output_file)
+
+
+def start_profiler(kind: str, output_file: str = None):
+    if kind is None:
+        return None
+    if output_file is None:
+        output_file = "railtrack.prof" if kind == "cprofile" else "railtrack.svg"
+    return Profiler(kind, output_file)
@@ -0,0 +1,54 @@
+import time
+import threading
+import importlib
+
+# Seconds spent importing each lazily imported module, filled on first use
+IMPORT_SECONDS = {}
+IMPORT_LOCK = threading.RLock()
+
+
+class LazyModule:
+    """Module imported on first attribute access
+
+    Heavy libraries (eccodes, xarray, pandas, scipy, joblib, matplotlib) are only
+    imported by the runs that use them, which keeps the startup of short jobs and
+    of argument parsing fast. Loading is thread safe.
+    """
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            with IMPORT_LOCK:
+                if self._module is None:
+                    start = time.perf_counter()
+                    module = importlib.import_module(self._name)
+                    IMPORT_SECONDS.setdefault(self._name, time.perf_counter() - start)
+                    self._module = module
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        return "<lazy module '{}'{}>".format(self._name, "" if self._module is None else " (loaded)")
+
+
+def lazy_import(name: str) -> LazyModule:
+    return LazyModule(name)
+
+
+def preload(*modules: LazyModule):
+    """Import lazy modules now, e.g. to fix the order of libraries that conflict with each other"""
+    for module in modules:
+        module._load()
+
+
+def import_report(startup_seconds: float, budget_seconds: float = None):
+    """Print the time of the eager imports at startup and of every lazily imported module"""
+    print("{:<28s} {:8.3f} s".format("startup imports", startup_seconds))
+    for name, seconds in sorted(IMPORT_SECONDS.items(), key=lambda item: -item[1]):
+        print("{:<28s} {:8.3f} s".format(name, seconds))
+    if budget_seconds is not None and startup_seconds > budget_seconds:
+        print("Startup imports take {:.3f} s, over the budget of {:.3f} s".format(startup_seconds, budget_seconds))
@@ -0,0 +1,160 @@
+import os
+import time
+import copy
+import argparse
+import numpy as np
+
+BACKENDS = ['joblib', 'booster', 'onnx', 'treelite']
+
+
+class BoosterBackend:
+    """Native XGBoost booster saved with Booster.save_model, no sklearn import needed"""
+    def __init__(self, model_file: str):
+        import xgboost
+        self.booster = xgboost.Booster(model_file=model_file)
+
+    def predict(self, features):
+        return self.booster.inplace_predict(np.asarray(features, dtype=np.float32))
+
+
+class OnnxBackend:
+    """Model exported to ONNX, run with ONNX Runtime"""
+    def __init__(self, model_file: str):
+        import onnxruntime
+        self.session = onnxruntime.InferenceSession(model_file, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def predict(self, features):
+        features = np.ascontiguousarray(features, dtype=np.float32)
+        return self.session.run(None, {self.input_name: features})[0].ravel()
+
+
+class TreeliteBackend:
+    """Tree ensemble compiled to a shared library with treelite/tl2cgen"""
+    def __init__(self, model_file: str):
+        import tl2cgen
+        self.tl2cgen = tl2cgen
+        self.predictor = tl2cgen.Predictor(model_file)
+
+    def predict(self, features):
+        features = np.ascontiguousarray(features, dtype=np.float32)
+        return self.predictor.predict(self.tl2cgen.DMatrix(features)).ravel()
+
+
+def load_backend(model_file: str, backend: str):
+    backends = {'booster': BoosterBackend, 'onnx': OnnxBackend, 'treelite': TreeliteBackend}
+    if backend not in backends:
+        raise ValueError("Unknown ML backend: {}".format(backend))
+    return backends[backend](model_file)
+
+
+def best_booster(model):
+    """Booster of a sklearn XGBoost model limited to the trees its predict() uses"""
+    booster = model.get_booster()
+    best_iteration = getattr(model, 'best_iteration', None)
+    if best_iteration is not None:
+        booster = booster[:best_iteration + 1]
+    return booster
+
+
+def convert(model, backend: str, output_file: str):
+    """Convert a joblib-loaded sklearn XGBoost model for a faster inference backend"""
+    booster = best_booster(model)
+    if backend == 'booster':
+        booster.save_model(output_file)
+    elif backend == 'onnx':
+        import onnxmltools
+        from onnxmltools.convert.common.data_types import FloatTensorType
+        # onnxmltools expects the default f0, f1, ... feature names
+        onnx_model = copy.deepcopy(model)
+        onnx_model.get_booster().feature_names = None
+        onnx_model = onnxmltools.convert_xgboost(
+            onnx_model, initial_types=[('features', FloatTensorType([None, booster.num_features()]))])
+        onnxmltools.utils.save_model(onnx_model, output_file)
+    elif backend == 'treelite':
+        import treelite
+        import tl2cgen
+        tl2cgen.export_lib(treelite.frontend.from_xgboost(booster), toolchain='gcc', libpath=output_file,
+                           params={'parallel_comp': os.cpu_count() or 1})
+    else:
+        raise ValueError("Cannot convert to ML backend: {}".format(backend))
+    print("wrote file '%s'" % output_file)
+
+
+def feature_sample(store_path: str, rows: int = 100000, seed: int = 0):
+    """Random rows of the model features of a feature store written with --feature_store
+
+    Only as many random time steps are read as are needed for the rows.
+    """
+    import eccodes
+    import tools as tl
+    import feature_store
+    ds, template = feature_store.open_feature_store(store_path)
+    eccodes.codes_release(template)
+    rng = np.random.default_rng(seed)
+    steps = ds.sizes['time']
+    points = int(np.prod(ds['T2'].shape)) // steps
+    times = np.sort(rng.choice(steps, size=min(steps, -(-rows // points)), replace=False))
+    features = tl.build_feature_matrix(ds, times)
+    return features[np.sort(rng.choice(len(features), size=min(rows, len(features)), replace=False))]
+
+
+def check_parity(model, backend_model, features=None, rows: int = 100000, seed: int = 0) -> float:
+    """Largest absolute prediction difference between the joblib model and a converted backend
+
+    features are real model features, e.g. from feature_sample(). Standard normal noise
+    is used without them, but it reaches few split thresholds of a model trained on
+    physical values.
+    """
+    import tools as tl
+    if features is None:
+        rng = np.random.default_rng(seed)
+        features = rng.normal(size=(rows, model.get_booster().num_features())).astype(np.float32)
+    rows = len(features)
+    start = time.time()
+    reference = tl.predict_features(model, features)
+    reference_time = time.time() - start
+    start = time.time()
+    predicted = backend_model.predict(features)
+    backend_time = time.time() - start
+    difference = float(np.max(np.abs(reference - predicted)))
+    print("{} rows: joblib {:.3f} s, backend {:.3f} s, max abs difference {:.3g}".format(
+        rows, reference_time, backend_time, difference))
+    return difference
+
+
+def main():
+    """Convert the joblib ML model to an inference backend and check their parity"""
+    import tools as tl
+    args = parse_command_line()
+    model = tl.load_ML_model(args.ML_model)
+    if args.command == 'convert':
+        convert(model, args.backend, args.output_file)
+    features = None if args.random_features else feature_sample(args.features, rows=args.rows)
+    difference = check_parity(model, load_backend(args.output_file, args.backend), features, rows=args.rows)
+    if difference > args.tolerance:
+        raise SystemExit("Backend predictions differ from the joblib model by {:.3g}".format(difference))
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(argument_default=None)
+    parser.add_argument("command", choices=["convert", "check"])
+    parser.add_argument("--ML_model", action="store", type=str, required=True,
+                        help="joblib model used as the reference")
+    parser.add_argument("--backend", action="store", type=str, required=True, choices=BACKENDS[1:])
+    parser.add_argument("--output_file", action="store", type=str, required=True,
+                        help="Converted model file: .ubj/.json booster, .onnx or .so library")
+    parser.add_argument("--features", action="store", type=str, default=None,
+                        help="Feature store written with --feature_store whose features are compared")
+    parser.add_argument("--random_features", action="store_true", default=False,
+                        help="Compare on standard normal noise instead of real features")
+    parser.add_argument("--rows", action="store", type=int, default=100000)
+    parser.add_argument("--tolerance", action="store", type=float, default=1e-3)
+    args = parser.parse_args()
+    if args.features is None and not args.random_features:
+        parser.error("--features is required unless --random_features is given")
+    return args
+
+
+if __name__ == '__main__':
+    main()
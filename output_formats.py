@@ -0,0 +1,112 @@
+import os
+import time
+import tempfile
+import importlib.util
+import numpy as np
+from lazy_imports import lazy_import
+from file_utils import s3_write_options
+from feature_store import storage_options
+import tools as tl
+
+xr = lazy_import("xarray")
+pd = lazy_import("pandas")
+fsspec = lazy_import("fsspec")
+
+# File extension of every output format besides GRIB2
+OUTPUT_FORMATS = {'zarr': '.zarr', 'netcdf': '.nc', 'parquet': '.parquet'}
+# Formats of the forecast grid, the others hold the values of --track_points
+GRID_FORMATS = ['zarr', 'netcdf']
+
+# Packages of which one is needed to write each format
+FORMAT_PACKAGES = {'zarr': ['zarr'], 'netcdf': ['netCDF4', 'h5netcdf'], 'parquet': ['pyarrow', 'fastparquet']}
+
+
+def missing_packages(output_format: str) -> list:
+    """Packages of which one must be installed to write output_format, empty if one is"""
+    packages = FORMAT_PACKAGES[output_format]
+    if any(importlib.util.find_spec(package) is not None for package in packages):
+        return []
+    return packages
+
+
+def output_path(output_file: str, output_format: str) -> str:
+    """Output of a format next to the GRIB output, e.g. fcst.zarr for fcst.grib2"""
+    root, _ = os.path.splitext(output_file)
+    return root + OUTPUT_FORMATS[output_format]
+
+
+def forecast_dataset(forecast, times, latitudes, longitudes, units: str):
+    return xr.Dataset(
+        data_vars=dict(rail_temperature=(["time", "x", "y"], forecast, {'units': units})),
+        coords=dict(lon=(["x", "y"], longitudes),
+                    lat=(["x", "y"], latitudes),
+                    time=np.asarray(times, dtype="datetime64[ns]")),
+        attrs=dict(description="Railtrack temperature forecast."),
+    )
+
+
+def write_zarr(forecast, times, latitudes, longitudes, path: str, units: str = 'K'):
+    """Zarr store of one compressed chunk per time step, written chunk by chunk also to S3"""
+    ds = forecast_dataset(forecast, times, latitudes, longitudes, units)
+    encoding = {'rail_temperature': {'chunks': (1,) + forecast.shape[1:]}}
+    ds.to_zarr(path, mode="w", encoding=encoding, storage_options=storage_options(path))
+
+
+def write_netcdf(forecast, times, latitudes, longitudes, path: str, units: str = 'K'):
+    """Compressed NetCDF4 file of one chunk per time step
+
+    HDF5 needs a seekable file, so an S3 output is written locally first and uploaded.
+    """
+    ds = forecast_dataset(forecast, times, latitudes, longitudes, units)
+    engine = "netcdf4" if importlib.util.find_spec("netCDF4") is not None else "h5netcdf"
+    encoding = {'rail_temperature': {'zlib': True, 'complevel': 4, 'chunksizes': (1,) + forecast.shape[1:]}}
+    local_file = path
+    if path.startswith("s3://"):
+        fd, local_file = tempfile.mkstemp(suffix=".nc")
+        os.close(fd)
+    try:
+        ds.to_netcdf(local_file, engine=engine, encoding=encoding)
+        if path.startswith("s3://"):
+            fsspec.filesystem("s3", **s3_write_options()).put_file(local_file, path)
+    finally:
+        if local_file != path:
+            os.remove(local_file)
+
+
+def write_parquet(points, times, forecast, path: str):
+    """Compact table of the forecast (C) of every track point and time, streamed to S3
+
+    The table is the same as the CSV or Parquet --output_file of tools.write_track_point_forecast().
+    Rows are sorted by time, so the repeated ids, coordinates and times compress to almost nothing.
+    """
+    table = tl.track_point_table(points, times, forecast)
+    table.to_parquet(path, index=False, compression="zstd", storage_options=storage_options(path))
+
+
+WRITERS = {'zarr': write_zarr, 'netcdf': write_netcdf}
+
+
+def write_outputs(forecast, times, latitudes, longitudes, output_file: str, output_formats: list, executor,
+                  units: str = 'K') -> list:
+    """Submit writers of the (time, x, y) forecast in output_formats to executor
+
+    All formats are written from the same in-memory forecast concurrently with each
+    other and with the GRIB encoding of the caller. Returns the futures.
+    """
+    return [executor.submit(timed_write, WRITERS[output_format], output_path(output_file, output_format),
+                            forecast, times, latitudes, longitudes, units=units)
+            for output_format in output_formats if output_format in GRID_FORMATS]
+
+
+def write_point_outputs(points, times, forecast, output_file: str, output_formats: list, executor) -> list:
+    """Submit writers of the (time, points) track point forecast in output_formats to executor"""
+    return [executor.submit(timed_write, write_parquet, output_path(output_file, output_format),
+                            points, times, forecast)
+            for output_format in output_formats if output_format == 'parquet']
+
+
+def timed_write(writer, path: str, *args, **kwargs) -> str:
+    start = time.time()
+    writer(*args, path=path, **kwargs)
+    print("wrote file '{}' in {:.2f} seconds".format(path, time.time() - start))
+    return path
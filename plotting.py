@@ -1,25 +1,38 @@
 import os
+import io
+import time
 import argparse
 import numpy as np
-import matplotlib
-import matplotlib.pyplot as plt
 from datetime import datetime as dt
-from datetime import timedelta as td
-from mpl_toolkits.basemap import Basemap
-import cartopy
+from concurrent.futures import ProcessPoolExecutor
+from lazy_imports import lazy_import, preload
 from file_utils import ReadData
 
+# Plotting libraries are imported on first use, argument parsing does not need them
+matplotlib = lazy_import("matplotlib")
+plt = lazy_import("matplotlib.pyplot")
+basemap = lazy_import("mpl_toolkits.basemap")
+
+# Map renderer of a plotting worker process, built once by init_renderer
+RENDERER = None
+
 
 def main():
-    pwd = os.getcwd()
-    pwd = os.path.split(pwd)[0]
-    fig_out = f"{pwd}/rail_temperature/figures/"
+    args = parse_command_line()
+    # Basemap has to be imported before eccodes, the other order crashes at exit
+    preload(basemap)
+    fig_out = args.output_dir
+    if fig_out is None:
+        pwd = os.getcwd()
+        pwd = os.path.split(pwd)[0]
+        fig_out = f"{pwd}/rail_temperature/figures/"
     if os.path.isdir(fig_out) is False:
         os.mkdir(fig_out)
+    fig_out = os.path.join(fig_out, "")
 
-    args = parse_command_line()
-    data = ReadData(args.input_file, read_coordinates=True,  time_steps=125)
-    plot_NWC_data_pcolormesh_polster(data, fig_out, "Railtrack temperature forecast from EC")
+    data = ReadData(args.input_file, read_coordinates=True,  time_steps=125, leadtimes=args.leadtimes)
+    plot_NWC_data_pcolormesh_polster(data, fig_out, "Railtrack temperature forecast from EC",
+                                     dpi=args.dpi, image_format=args.format, workers=args.workers)
 
 
 def params_data_comparison():
@@ -30,54 +43,92 @@ def params_data_comparison():
         os.mkdir(fig_out)
 
     args = parse_command_line()
-    data = ReadData(args.input_file, read_coordinates=True,  time_steps=125)
-    comparison = ReadData(args.comparison_file, read_coordinates=True, time_steps=125)
+    preload(basemap)
+    data = ReadData(args.input_file, read_coordinates=True,  time_steps=125, leadtimes=args.leadtimes)
+    comparison = ReadData(args.comparison_file, read_coordinates=True, time_steps=125, leadtimes=args.leadtimes)
     plot_dataset_difference_polster(data, comparison, fig_out, "Railtrack temperature forecast from EC")
 
 
-def plot_NWC_data_pcolormesh_polster(data, outfile, title):
+def plot_NWC_data_pcolormesh_polster(data, outfile, title, dpi: int = 300, image_format: str = "png", workers: int = 1):
     """Use for plotting when projection is Polster/Polar_stereografic
 
     Only for Scandinavian domain. For other domains coordinates must be changed.
+    The map is built once per process and every frame only updates the mesh
+    values and the title. Frames are written as png or webp images, or as one
+    animated gif. With workers > 1 frames are rendered in a process pool.
     """
-    cmap = matplotlib.cm.coolwarm       #"coolwarm", 'RdBl_r'  'Blues' 'Jet' 'RdYlGn_r'
-    lon = data.longitudes
-    lat = data.latitudes
-    fig_date = data.analysis_time
-
+    start = time.time()
     # Calculate floating zero point
     vmin = 5 * round(int(np.min(data.data - 273.15) - 2) / 5)
     vmax = 5 * round(int(np.max(data.data - 273.15) + 2) / 5)
     zero_point = (abs(vmin)/(abs(vmin) + abs(vmax)))
-    s_cmap = shiftedColorMap(cmap, midpoint=zero_point, name='shifted')
 
+    analysis = data.analysis_time
+    fig_date = data.analysis_time
+    frames = []
     for i in range(len(data.data)):
         hour = 0
-        fig, ax = plt.subplots(1, 1, figsize=(16, 12))
-        if i > 0:
-            hour = (data.dtime[i] - data.dtime[0]).total_seconds() / 3600
+        if data.dtime[i] > data.analysis_time:
+            hour = (data.dtime[i] - data.analysis_time).total_seconds() / 3600
             fig_date = data.dtime[i]
-        m = Basemap(width=970000, height=1300000,
+        frame_title = f"{title} {dt.strftime(fig_date, '%Y-%m-%d %H:%M')},\n Analysistime {analysis}, forecast + {int(hour)}h)"
+        forecast_outfile = outfile + f"{dt.strftime(data.analysis_time, '%Y%m%d%H%M')}_TRAIL_fcst+{int(hour)}h.{image_format}"
+        frames.append((data.data[i] - 273.15, frame_title, None if image_format == "gif" else forecast_outfile))
+
+    renderer_args = (data.latitudes, data.longitudes, vmin, vmax, zero_point, dpi)
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_renderer, initargs=renderer_args) as executor:
+            images = list(executor.map(render_frame, frames, chunksize=max(1, len(frames) // (4 * workers))))
+    else:
+        init_renderer(*renderer_args)
+        images = [render_frame(frame) for frame in frames]
+    if image_format == "gif":
+        from PIL import Image
+        animation_outfile = outfile + f"{dt.strftime(data.analysis_time, '%Y%m%d%H%M')}_TRAIL_fcst.gif"
+        images = [Image.open(io.BytesIO(image)) for image in images]
+        images[0].save(animation_outfile, save_all=True, append_images=images[1:], duration=500, loop=0)
+        print("wrote file '%s'" % animation_outfile)
+    print("Plotted {} frames in {:.2f} seconds".format(len(frames), time.time() - start))
+
+
+class MapRenderer:
+    """Figure with the map, projected grid and colorbar drawn once, reused for every frame"""
+    def __init__(self, lat, lon, vmin, vmax, zero_point, dpi: int = 300):
+        self.dpi = dpi
+        cmap = matplotlib.cm.coolwarm       #"coolwarm", 'RdBl_r'  'Blues' 'Jet' 'RdYlGn_r'
+        s_cmap = shiftedColorMap(cmap, midpoint=zero_point, name='shifted')
+        self.fig, ax = plt.subplots(1, 1, figsize=(16, 12))
+        m = basemap.Basemap(width=970000, height=1300000,
                     resolution='i', rsphere=(6378137.00,6356752.3142),
                     projection='lcc', ellps='WGS84',
                     lat_1=64.8, lat_2=64.8, lat_0=64.8, lon_0=26.0, ax=ax)
         m.drawcountries(linewidth=1.0)
         m.drawcoastlines(1.0)
-        d = data.data[i, :, :] - 273.15
-        d[0, 0] = vmin
-        d[-1, -1] = vmax
         x, y = m(lon, lat)
+        self.mesh = m.pcolormesh(x, y, np.zeros(np.shape(lat)), cmap=s_cmap, vmin=vmin, vmax=vmax)
+        self.title = ax.set_title("")
+        self.fig.colorbar(self.mesh, fraction=0.033, pad=0.04, orientation="horizontal")
 
-        if i == 0:
-            cm = m.pcolormesh(x, y, d, cmap=s_cmap)
-        else:
-            cm = m.pcolormesh(x, y, d, cmap=s_cmap)
-        analysis = data.analysis_time - td(hours=int(1))
-        plt.title(f"{title} {dt.strftime(fig_date, '%Y-%m-%d %H:%M')},\n Analysistime {analysis}, forecast + {int(hour) + 1}h)")
-        plt.colorbar(cm, fraction=0.033, pad=0.04, orientation="horizontal")
-        forecast_outfile = outfile + f"{dt.strftime(data.analysis_time, '%Y%m%d%H%M')}_TRAIL_fcst+{int(hour) + 1}h.png"
-        plt.savefig(forecast_outfile, dpi=300, bbox_inches='tight', pad_inches=0.2)
-        plt.close()
+    def render(self, values, title: str, output_file: str = None):
+        """Save the frame to output_file, or return it as png bytes if no file is given"""
+        self.mesh.set_array(np.ma.masked_invalid(values).ravel())
+        self.title.set_text(title)
+        if output_file is not None:
+            self.fig.savefig(output_file, dpi=self.dpi, bbox_inches='tight', pad_inches=0.2)
+            return None
+        # Animation frames keep the full figure size so that they all match
+        buffer = io.BytesIO()
+        self.fig.savefig(buffer, format="png", dpi=self.dpi)
+        return buffer.getvalue()
+
+
+def init_renderer(*renderer_args):
+    global RENDERER
+    RENDERER = MapRenderer(*renderer_args)
+
+
+def render_frame(frame):
+    return RENDERER.render(*frame)
 
 
 def plot_dataset_difference_polster(data, comparison, outfile, title):
@@ -102,10 +153,10 @@ def plot_dataset_difference_polster(data, comparison, outfile, title):
     for i in range(len(data.data)):
         hour = 0
         fig, ax = plt.subplots(1, 1, figsize=(16, 12))
-        if i > 0:
-            hour = (data.dtime[i] - data.dtime[0]).total_seconds() / 3600
+        if data.dtime[i] > data.analysis_time:
+            hour = (data.dtime[i] - data.analysis_time).total_seconds() / 3600
             fig_date = data.dtime[i]
-        m = Basemap(width=970000, height=1300000,
+        m = basemap.Basemap(width=970000, height=1300000,
                     resolution='i', rsphere=(6378137.00,6356752.3142),
                     projection='lcc', ellps='WGS84',
                     lat_1=64.8, lat_2=64.8, lat_0=64.8, lon_0=26.0, ax=ax)
@@ -121,15 +172,16 @@ def plot_dataset_difference_polster(data, comparison, outfile, title):
             cm = m.pcolormesh(x, y, d, cmap=s_cmap)
         else:
             cm = m.pcolormesh(x, y, d, cmap=cmap)
-        analysis = data.analysis_time - td(hours=int(1))
-        plt.title(f"{title} {dt.strftime(fig_date, '%Y-%m-%d %H:%M')},\n Analysistime {analysis}, forecast + {int(hour) + 1}h)")
+        analysis = data.analysis_time
+        plt.title(f"{title} {dt.strftime(fig_date, '%Y-%m-%d %H:%M')},\n Analysistime {analysis}, forecast + {int(hour)}h)")
         plt.colorbar(cm, fraction=0.033, pad=0.04, orientation="horizontal")
-        forecast_outfile = outfile + f"{dt.strftime(data.analysis_time, '%Y%m%d%H%M')}_TRAIL_fcst+{int(hour) + 1}h.png"
+        forecast_outfile = outfile + f"{dt.strftime(data.analysis_time, '%Y%m%d%H%M')}_TRAIL_fcst+{int(hour)}h.png"
         plt.savefig(forecast_outfile, dpi=300, bbox_inches='tight', pad_inches=0.2)
         plt.close()
 
 
 def generate_fig(proj):
+    import cartopy
     ax = plt.axes(projection=proj)
     ax.set_extent([0, 39, 51, 73])
     ax.gridlines()
@@ -143,6 +195,15 @@ def generate_fig(proj):
 def parse_command_line():
     parser = argparse.ArgumentParser(argument_default=None)
     parser.add_argument("--input_file", action="store", type=str, required=True)
+    parser.add_argument("--leadtimes", action="store", type=int, nargs="+", default=None,
+                        help="Plot only these lead times (hours), decoded through the GRIB index")
+    parser.add_argument("--output_dir", action="store", type=str, default=None,
+                        help="Directory of the figures, ../rail_temperature/figures/ by default")
+    parser.add_argument("--dpi", action="store", type=int, default=300)
+    parser.add_argument("--format", action="store", type=str, default="png", choices=["png", "webp", "gif"],
+                        help="Image format of the frames, gif writes one animation of all frames")
+    parser.add_argument("--workers", action="store", type=int, default=1,
+                        help="Number of processes rendering frames")
     args = parser.parse_args()
     return args
 
@@ -169,7 +230,7 @@ def shiftedColorMap(cmap, start=0, midpoint=0.5, stop=1.0, name='shiftedcmap'):
         cdict['alpha'].append((si, a, a))
 
     newcmap = matplotlib.colors.LinearSegmentedColormap(name, cdict)
-    plt.register_cmap(cmap=newcmap)
+    matplotlib.colormaps.register(cmap=newcmap, force=True)
 
     return newcmap
 
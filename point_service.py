@@ -0,0 +1,171 @@
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import datetime
+import threading
+import numpy as np
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import tools as tl
+from file_utils import ReadData
+
+
+class ForecastCube:
+    """Railtrack temperature forecast of one output GRIB file held in memory"""
+    def __init__(self, forecast_file: str, previous=None):
+        start = time.time()
+        grib_file = ReadData.open(forecast_file)
+        self.forecast_file = forecast_file
+        self.mtime = os.stat(grib_file.local_file).st_mtime
+        self.analysis_time = grib_file.analysis_time
+        self.times = np.array([self.analysis_time + lt for lt in grib_file.leadtimes])
+        self.data = grib_file[:] - 273.15
+        self.latitudes = grib_file.latitudes
+        self.longitudes = grib_file.longitudes
+        if previous is not None and np.array_equal(previous.latitudes, self.latitudes) \
+                and np.array_equal(previous.longitudes, self.longitudes):
+            # The KD-tree and the interpolation weights depend only on the grid
+            self.tree, self.max_distance = previous.tree, previous.max_distance
+            self.weights, self.weights_lock = previous.weights, previous.weights_lock
+        else:
+            self.tree = tl.grid_tree(self.latitudes, self.longitudes)
+            self.max_distance = tl.grid_step(self.latitudes, self.longitudes)
+            self.weights, self.weights_lock = {}, threading.Lock()
+        print("Loaded {} in {:.2f} seconds".format(forecast_file, time.time() - start))
+
+    def query(self, lats: list, lons: list, times: list = None) -> dict:
+        indices, weights = self.point_weights(lats, lons)
+        steps = np.arange(len(self.times))
+        if times:
+            requested = np.array([datetime.datetime.fromisoformat(t) for t in times])
+            steps = np.searchsorted(self.times, requested)
+            if np.any(steps >= len(self.times)) or np.any(self.times[np.minimum(steps, len(self.times) - 1)] != requested):
+                raise KeyError("Requested times not in forecast {}".format(self.analysis_time))
+        values = tl.interpolate_to_points(self.data[steps], indices, weights)
+        return {'analysis_time': self.analysis_time.isoformat(),
+                'times': [t.isoformat() for t in self.times[steps]],
+                'rail_temperature': np.round(values.T, 2).tolist()}
+
+    def point_weights(self, lats: list, lons: list):
+        # Weights of repeated point sets (e.g. a dispatcher's station list) are cached,
+        # the cache is shared by the request threads
+        key = (tuple(lats), tuple(lons))
+        with self.weights_lock:
+            weights = self.weights.get(key)
+        if weights is None:
+            weights = tl.point_interpolation_weights(self.latitudes, self.longitudes, lats, lons,
+                                                     tree=self.tree, max_distance=self.max_distance)
+            outside = np.isnan(weights[1][:, 0])
+            if np.any(outside):
+                raise ValueError("Points outside the grid: {}".format(
+                    list(zip(np.asarray(lats)[outside].tolist(), np.asarray(lons)[outside].tolist()))))
+            with self.weights_lock:
+                if len(self.weights) > 1000:
+                    self.weights.clear()
+                self.weights[key] = weights
+        return weights
+
+
+class ForecastStore:
+    """Keeps the newest forecast cube and reloads it when a new run lands"""
+    def __init__(self, input_file: str):
+        self.input_file = input_file
+        self.cube = ForecastCube(self.latest_file())
+
+    def latest_file(self) -> str:
+        # input_file may be a glob pattern matching files of consecutive runs
+        files = sorted(glob.glob(self.input_file)) if not self.input_file.startswith("s3://") else [self.input_file]
+        if len(files) == 0:
+            sys.exit("No forecast files found: {}".format(self.input_file))
+        return files[-1]
+
+    def reload_if_changed(self):
+        forecast_file = self.latest_file()
+        if forecast_file.startswith("s3://"):
+            # S3 objects are served as loaded, only local files are watched
+            return
+        if forecast_file != self.cube.forecast_file or os.stat(forecast_file).st_mtime != self.cube.mtime:
+            # Queries keep using the old cube until the new one is completely loaded
+            self.cube = ForecastCube(forecast_file, previous=self.cube)
+
+    def watch(self, poll_seconds: float):
+        while True:
+            time.sleep(poll_seconds)
+            try:
+                self.reload_if_changed()
+            except Exception as e:
+                print("Reloading forecast failed: {}".format(e))
+
+
+def make_handler(store: ForecastStore):
+    class ForecastHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path != "/forecast":
+                return self.send_json(404, {'error': 'unknown path'})
+            query = parse_qs(url.query)
+            try:
+                lats = [float(v) for v in query['lat']]
+                lons = [float(v) for v in query['lon']]
+                self.answer(lats, lons, query.get('time'))
+            except (KeyError, ValueError) as e:
+                self.send_json(400, {'error': str(e)})
+
+        def do_POST(self):
+            if urlparse(self.path).path != "/forecast":
+                return self.send_json(404, {'error': 'unknown path'})
+            try:
+                request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                lats = [float(point[0]) for point in request['points']]
+                lons = [float(point[1]) for point in request['points']]
+                self.answer(lats, lons, request.get('times'))
+            except (KeyError, ValueError, TypeError, IndexError) as e:
+                self.send_json(400, {'error': str(e)})
+
+        def answer(self, lats, lons, times):
+            if len(lats) != len(lons) or len(lats) == 0:
+                raise ValueError("lat and lon must be given for every point")
+            self.send_json(200, store.cube.query(lats, lons, times))
+
+        def send_json(self, status: int, content: dict):
+            body = json.dumps(content).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return ForecastHandler
+
+
+def main():
+    """Serve railtrack temperature point forecasts over HTTP
+
+    GET /forecast?lat=60.2&lon=24.9[&lat=..&lon=..][&time=2024-10-18T06:00:00]
+    POST /forecast {"points": [[60.2, 24.9], ...], "times": [...]}
+    """
+    args = parse_command_line()
+    store = ForecastStore(args.input_file)
+    threading.Thread(target=store.watch, args=(args.poll_seconds,), daemon=True).start()
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(store))
+    print("Serving point forecasts on {}:{}".format(args.host, args.port))
+    server.serve_forever()
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(argument_default=None)
+    parser.add_argument("--input_file", action="store", type=str, required=True,
+                        help="Output GRIB of the forecast, or a glob pattern of which the last match is served")
+    parser.add_argument("--host", action="store", type=str, default="127.0.0.1")
+    parser.add_argument("--port", action="store", type=int, default=8080)
+    parser.add_argument("--poll_seconds", action="store", type=float, default=60,
+                        help="Interval of checking for a new forecast run")
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    main()
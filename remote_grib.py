@@ -0,0 +1,135 @@
+import json
+import time
+import struct
+import argparse
+import file_utils
+from file_cache import find_s3_object
+from lazy_imports import lazy_import
+
+fsspec = lazy_import("fsspec")
+eccodes = lazy_import("eccodes")
+
+# Bytes read from the start of every message while scanning, enough for sections 0-4 of most messages
+HEADER_BYTES = 1024
+# Messages fetched concurrently in one batch of range requests
+FETCH_BATCH = 32
+# Message indexes of remote files read in this process by URI and ETag
+REMOTE_INDEXES = {}
+
+
+class RangeReader:
+    """Byte range reads of an S3 object, counting the requests and transferred bytes"""
+    def __init__(self, uri: str):
+        self.uri = uri
+        self.fs, info = find_s3_object(uri)
+        self.size = info['size']
+        self.etag = info.get('ETag')
+        self.requests = 0
+        self.bytes_read = 0
+
+    def read(self, start: int, end: int) -> bytes:
+        data = self.fs.cat_file(self.uri, start=start, end=end)
+        self.requests += 1
+        self.bytes_read += len(data)
+        return data
+
+    def read_ranges(self, ranges: list) -> list:
+        """Read (start, end) ranges concurrently"""
+        data = self.fs.cat_ranges([self.uri] * len(ranges), [r[0] for r in ranges], [r[1] for r in ranges])
+        self.requests += len(ranges)
+        self.bytes_read += sum(len(d) for d in data)
+        return data
+
+
+def header_message(message_start: bytes, length: int, read_more) -> bytes:
+    """GRIB2 message of the sections 1-4 of a message and an empty constant field
+
+    eccodes parses every header key of such a message like of the original one,
+    without its data sections being fetched. read_more(end) returns the start of
+    the original message up to end when message_start does not hold sections 1-4.
+    """
+    position = 16
+    while True:
+        if position + 5 > len(message_start):
+            message_start = read_more(min(position + HEADER_BYTES, length))
+        section_length, section = struct.unpack(">IB", message_start[position:position + 5])
+        if section == 3:
+            points = struct.unpack(">I", message_start[position + 6:position + 10])[0]
+        if section >= 5:
+            break
+        position += section_length
+    data_sections = (struct.pack(">IBIHfhhBB", 21, 5, points, 0, 0.0, 0, 0, 0, 0)
+                     + struct.pack(">IBB", 6, 6, 255) + struct.pack(">IB", 5, 7) + b"7777")
+    total_length = position + len(data_sections)
+    return message_start[:8] + struct.pack(">Q", total_length) + message_start[16:position] + data_sections
+
+
+def scan_grib_index(reader: RangeReader) -> list:
+    """Index of the messages of a remote GRIB2 file from one small range request per message
+
+    The section 0 of a message gives its length and with that the offset of the
+    next message. A truncated last message is left out.
+    """
+    messages = []
+    offset = 0
+    while offset + 16 <= reader.size:
+        message_start = reader.read(offset, min(offset + HEADER_BYTES, reader.size))
+        if message_start[:4] != b"GRIB" or message_start[7] != 2:
+            raise ValueError("No GRIB2 message at byte {} of {}".format(offset, reader.uri))
+        length = struct.unpack(">Q", message_start[8:16])[0]
+        if offset + length > reader.size:
+            print("GRIB file {} ends with a truncated message at byte {}".format(reader.uri, offset))
+            break
+        header = header_message(message_start, length, lambda end: reader.read(offset, offset + end))
+        gh = eccodes.codes_new_from_message(header)
+        messages.append(file_utils.grib_index_entry(gh, offset, length))
+        eccodes.codes_release(gh)
+        offset += length
+    return messages
+
+
+def load_remote_grib_index(reader: RangeReader) -> list:
+    """Message index of a remote GRIB file from its published sidecar index, or by scanning the headers"""
+    key = (reader.uri, reader.etag)
+    if key in REMOTE_INDEXES:
+        return REMOTE_INDEXES[key]
+    try:
+        index = json.loads(reader.fs.cat_file(reader.uri + ".idx.json"))
+        if index.get("version") == file_utils.GRIB_INDEX_VERSION and index["size"] == reader.size:
+            REMOTE_INDEXES[key] = index["messages"]
+            return index["messages"]
+    except (FileNotFoundError, ValueError, KeyError):
+        pass
+    start = time.time()
+    messages = scan_grib_index(reader)
+    print("Scanned {} messages of {} with {} range requests in {:.2f} seconds".format(
+        len(messages), reader.uri, reader.requests, time.time() - start))
+    REMOTE_INDEXES[key] = messages
+    return messages
+
+
+def publish_grib_index(uri: str) -> str:
+    """Scan a remote GRIB file and write its sidecar index next to it, so readers need not scan"""
+    reader = RangeReader(uri)
+    index = {"version": file_utils.GRIB_INDEX_VERSION, "size": reader.size, "messages": scan_grib_index(reader)}
+    index_uri = uri + ".idx.json"
+    fsspec.filesystem("s3", **file_utils.s3_write_options()).pipe_file(index_uri, json.dumps(index).encode())
+    print("wrote file '%s'" % index_uri)
+    return index_uri
+
+
+def main():
+    """Publish sidecar indexes of GRIB files in S3 for byte range reads"""
+    args = parse_command_line()
+    for uri in args.uris:
+        publish_grib_index(uri)
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(argument_default=None)
+    parser.add_argument("uris", action="store", type=str, nargs="+", help="S3 URIs of GRIB2 files")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
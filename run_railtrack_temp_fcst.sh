@@ -37,4 +37,7 @@ $PYTHON ./generate_ML_temperature_rail_fcst.py --T2 "$T2" --D2 "$D2" --SKT "$SKT
 # Check if "figures" is in project. If not, create one
 #mkdir -p "$PWD"/figures
 # Generating visualizations for each forecasted time steps
-#$PYTHON plotting.py --input_file $OUTPUT
\ No newline at end of file
+#$PYTHON plotting.py --input_file $OUTPUT
+
+# Reforecast/backfill of many analysis times in one process, e.g.
+#$PYTHON ./batch_ML_temperature_rail_fcst.py --start_time 202401010000 --end_time 202401311200 --interval_hours 12 --ML_model "$ML" --output_template "{start_time}_rail_temp.grib2"
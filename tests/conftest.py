@@ -0,0 +1,34 @@
+import os
+import sys
+import pytest
+
+# The modules of the repository are imported from its root directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class S3Server:
+    """Local moto S3 server with a public bucket 'trail'"""
+    def __init__(self):
+        server = pytest.importorskip("moto.server")
+        boto3 = pytest.importorskip("boto3")
+        self.server = server.ThreadedMotoServer(ip_address="127.0.0.1", port=0)
+        self.server.start()
+        self.endpoint_url = "http://127.0.0.1:{}".format(self.server.get_host_and_port()[1])
+        self.client = boto3.client("s3", endpoint_url=self.endpoint_url, aws_access_key_id="test",
+                                   aws_secret_access_key="test", region_name="us-east-1")
+        self.client.create_bucket(Bucket="trail", ACL="public-read")
+
+    def put(self, key: str, data: bytes) -> str:
+        self.client.put_object(Bucket="trail", Key=key, Body=data, ACL="public-read")
+        return "s3://trail/" + key
+
+    def upload(self, key: str, local_file: str) -> str:
+        self.client.upload_file(local_file, "trail", key, ExtraArgs={'ACL': 'public-read'})
+        return "s3://trail/" + key
+
+
+@pytest.fixture(scope="session")
+def s3_server():
+    s3 = S3Server()
+    yield s3
+    s3.server.stop()
@@ -0,0 +1,96 @@
+"""Ensemble percentiles and exceedance probabilities, and the GRIB keys defining them"""
+import numpy as np
+import pytest
+import eccodes
+import benchmark
+import tools as tl
+from test_forecast_parity import run_forecast, NY, NX
+
+MEMBERS, STEPS = 3, 6
+PERCENTILES = ["0", "50", "100"]
+
+
+def read_messages(grib_file: str, keys: list) -> list:
+    """Keys and values of the messages in grib_file"""
+    messages = []
+    with open(grib_file, "rb") as fp:
+        while True:
+            gh = eccodes.codes_grib_new_from_file(fp)
+            if gh is None:
+                break
+            message = {key: eccodes.codes_get(gh, key) for key in keys}
+            message['values'] = eccodes.codes_get_values(gh)
+            messages.append(message)
+            eccodes.codes_release(gh)
+    return messages
+
+
+def product_values(grib_file: str) -> np.ndarray:
+    return np.array([message['values'] for message in read_messages(grib_file, ["forecastTime"])])
+
+
+@pytest.fixture(scope="module")
+def files(tmp_path_factory):
+    return benchmark.make_fixtures(str(tmp_path_factory.mktemp("fixtures")), NY, NX, STEPS, members=MEMBERS)
+
+
+@pytest.fixture(scope="module")
+def percentiles(files, tmp_path_factory):
+    """Minimum, median and maximum of the members in Kelvin, by (percentile, time, cell)"""
+    output_file = str(tmp_path_factory.mktemp("percentiles") / "out.grib2")
+    run_forecast(files, output_file, "--ensemble", "--percentiles", *PERCENTILES, read_output=False)
+    return {percentile: product_values(output_file.replace(".grib2", "_p{}.grib2".format(percentile)))
+            for percentile in PERCENTILES}
+
+
+def test_ensemble_products_of_three_members():
+    forecast = np.array([[[1.0, 5.0]], [[2.0, 4.0]], [[3.0, 6.0]]], dtype=np.float32)
+    quantiles, probabilities = tl.ensemble_products(forecast, [0, 50, 100], [2.5, 4.5, 1.0])
+    np.testing.assert_allclose(quantiles, [[[1, 4]], [[2, 5]], [[3, 6]]])
+    np.testing.assert_allclose(probabilities, [[[100 / 3, 100]], [[0, 200 / 3]], [[100 / 3 * 2, 100]]], rtol=1e-6)
+    assert quantiles.dtype == probabilities.dtype == np.float32
+
+
+def test_percentile_keys_and_order(files, percentiles, tmp_path):
+    output_file = str(tmp_path / "out.grib2")
+    run_forecast(files, output_file, "--ensemble", "--percentiles", "50", read_output=False)
+    messages = read_messages(output_file.replace(".grib2", "_p50.grib2"),
+                             ["productDefinitionTemplateNumber", "percentileValue", "forecastTime"])
+    assert len(messages) == STEPS - 1
+    assert all(m['productDefinitionTemplateNumber'] == 6 and m['percentileValue'] == 50 for m in messages)
+    assert np.all(percentiles["0"] <= percentiles["50"] + 1e-3)
+    assert np.all(percentiles["50"] <= percentiles["100"] + 1e-3)
+    assert np.any(percentiles["100"] - percentiles["0"] > 0.1)
+
+
+def test_exceedance_keys_and_values(files, percentiles, tmp_path):
+    median = percentiles["50"]
+    threshold = round(float(np.median(median)) - 273.15, 2)
+    thresholds = [-100.0, threshold, 100.0]
+    output_file = str(tmp_path / "out.grib2")
+    run_forecast(files, output_file, "--ensemble", "--percentiles", "50",
+                 "--exceedance_thresholds", *[str(t) for t in thresholds], read_output=False)
+    keys = ["productDefinitionTemplateNumber", "probabilityType", "scaleFactorOfUpperLimit",
+            "scaledValueOfUpperLimit", "forecastProbabilityNumber", "totalNumberOfForecastProbabilities"]
+    for number, threshold_C in enumerate(thresholds, 1):
+        messages = read_messages(output_file.replace(".grib2", "_exceed{:g}C.grib2".format(threshold_C)), keys)
+        assert len(messages) == STEPS - 1
+        for message in messages:
+            assert message['productDefinitionTemplateNumber'] == 5
+            assert message['probabilityType'] == 1
+            assert message['forecastProbabilityNumber'] == number
+            assert message['totalNumberOfForecastProbabilities'] == len(thresholds)
+            upper_limit = message['scaledValueOfUpperLimit'] / 10 ** message['scaleFactorOfUpperLimit']
+            assert upper_limit == pytest.approx(threshold_C + 273.15)
+
+    probabilities = product_values(output_file.replace(".grib2", "_exceed{:g}C.grib2".format(threshold)))
+    np.testing.assert_allclose(product_values(output_file.replace(".grib2", "_exceed-100C.grib2")), 100, atol=0.01)
+    np.testing.assert_allclose(product_values(output_file.replace(".grib2", "_exceed100C.grib2")), 0, atol=0.01)
+    # Three members only give probabilities of whole thirds
+    np.testing.assert_allclose(probabilities * 3 / 100, np.round(probabilities * 3 / 100), atol=0.01)
+    # Cells clearly above or below the threshold by the min, median and max of the members
+    threshold_K = threshold + 273.15
+    clear = np.abs(np.stack([percentiles[p] for p in PERCENTILES]) - threshold_K).min(axis=0) > 0.01
+    members_above = sum(percentiles[p] > threshold_K for p in PERCENTILES)
+    assert clear.mean() > 0.5
+    np.testing.assert_allclose(probabilities[clear], 100 * members_above[clear] / 3, atol=0.01)
@@ -0,0 +1,70 @@
+"""FileCache against a local S3 server: hits, ETag invalidation, eviction and concurrent use"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+from file_cache import FileCache
+
+
+def read(path: str) -> bytes:
+    with open(path, "rb") as fp:
+        return fp.read()
+
+
+def test_hit_after_miss(s3_server, tmp_path):
+    uri = s3_server.put("cache/hit.grib2", b"a" * 100)
+    cache = FileCache(str(tmp_path), endpoints=[s3_server.endpoint_url])
+    local_file = cache.get(uri)
+    assert cache.get(uri) == local_file
+    assert read(local_file) == b"a" * 100
+    assert (cache.hits, cache.misses, cache.bytes_downloaded) == (1, 1, 100)
+    assert os.path.basename(local_file).endswith("_hit.grib2")
+
+
+def test_changed_object_is_downloaded_again(s3_server, tmp_path):
+    uri = s3_server.put("cache/changed.grib2", b"old")
+    cache = FileCache(str(tmp_path), endpoints=[s3_server.endpoint_url])
+    old_file = cache.get(uri)
+    s3_server.put("cache/changed.grib2", b"new version")
+    new_file = cache.get(uri)
+    assert new_file != old_file
+    assert read(new_file) == b"new version"
+    assert cache.misses == 2
+
+
+def test_superseded_version_is_removed(s3_server, tmp_path):
+    uri = s3_server.put("cache/growing.grib2", b"first steps")
+    other = s3_server.put("cache/other.grib2", b"other")
+    cache = FileCache(str(tmp_path), endpoints=[s3_server.endpoint_url])
+    old_file, other_file = cache.get(uri), cache.get(other)
+    with open(old_file + ".idx.json", "w") as fp:
+        fp.write("{}")
+    s3_server.put("cache/growing.grib2", b"first steps and more steps")
+    new_file = cache.get(uri)
+    assert not os.path.exists(old_file) and not os.path.exists(old_file + ".idx.json")
+    assert sorted(cache.cached_files()) == sorted([new_file, other_file])
+    assert cache.stats()['cache_size'] == len(b"first steps and more steps") + len(b"other")
+
+
+def test_least_recently_used_files_are_evicted(s3_server, tmp_path):
+    uris = [s3_server.put("cache/lru{}.grib2".format(i), bytes([i]) * 1000) for i in range(3)]
+    cache = FileCache(str(tmp_path), max_size=2500, endpoints=[s3_server.endpoint_url])
+    first, second = cache.get(uris[0]), cache.get(uris[1])
+    # The first file is used after the second one, so the second is the least recently used
+    os.utime(second, (1, 1))
+    os.utime(first, (2, 2))
+    third = cache.get(uris[2])
+    assert os.path.exists(first) and os.path.exists(third)
+    assert not os.path.exists(second)
+    assert cache.stats()['cache_size'] == 2000
+
+
+def test_concurrent_get(s3_server, tmp_path):
+    data = os.urandom(100000)
+    uri = s3_server.put("cache/concurrent.grib2", data)
+    cache = FileCache(str(tmp_path), endpoints=[s3_server.endpoint_url])
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        local_files = list(executor.map(cache.get, [uri] * 32))
+    assert len(set(local_files)) == 1
+    assert read(local_files[0]) == data
+    assert cache.hits + cache.misses == 32
+    assert cache.cached_files() == local_files[:1]
+    assert not [name for _, _, names in os.walk(str(tmp_path)) for name in names if name.endswith(".tmp")]
@@ -0,0 +1,113 @@
+"""The processing paths of generate_ML_temperature_rail_fcst.py give the same forecast
+
+The forecasts are run as separate processes on small synthetic input made with
+benchmark.make_fixtures() and compared by their decoded output GRIB values.
+"""
+import os
+import sys
+import subprocess
+import numpy as np
+import pytest
+import eccodes
+import benchmark
+import tools as tl
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(REPO_DIR, "generate_ML_temperature_rail_fcst.py")
+NY, NX, STEPS = 6, 8, 30
+# float32 decoding and features may move the forecast by less than the benchmark tolerance
+DTYPE_TOLERANCE = 0.05
+
+
+def run_forecast(files: dict, output_file: str, *options, env: dict = None, read_output: bool = True):
+    command = [sys.executable, SCRIPT, "--ML_model", files['ML_model'], "--output_file", output_file]
+    for name in tl.PREDICTOR_FILE_SUFFIXES:
+        command += ["--" + name, files[name]]
+    result = subprocess.run(command + list(options), cwd=REPO_DIR, env=env, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, text=True)
+    assert result.returncode == 0, result.stdout
+    return read_forecast(output_file) if read_output else None
+
+
+def run_from_feature_store(files: dict, output_file: str, store: str):
+    command = [sys.executable, SCRIPT, "--ML_model", files['ML_model'], "--output_file", output_file,
+               "--from_feature_store", store]
+    result = subprocess.run(command, cwd=REPO_DIR, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    assert result.returncode == 0, result.stdout
+    return read_forecast(output_file)
+
+
+def read_forecast(grib_file: str) -> dict:
+    """Values of the output messages by forecastTime"""
+    forecast = {}
+    with open(grib_file, "rb") as fp:
+        while True:
+            gh = eccodes.codes_grib_new_from_file(fp)
+            if gh is None:
+                break
+            forecast[eccodes.codes_get(gh, "forecastTime")] = eccodes.codes_get_values(gh)
+            eccodes.codes_release(gh)
+    return forecast
+
+
+def assert_same_forecast(forecast: dict, reference: dict, tolerance: float = 0.0):
+    assert sorted(forecast) == sorted(reference)
+    for forecast_time, values in reference.items():
+        np.testing.assert_allclose(forecast[forecast_time], values, rtol=0, atol=tolerance,
+                                   err_msg="forecastTime {}".format(forecast_time))
+
+
+@pytest.fixture(scope="module")
+def files(tmp_path_factory):
+    return benchmark.make_fixtures(str(tmp_path_factory.mktemp("fixtures")), NY, NX, STEPS)
+
+
+@pytest.fixture(scope="module")
+def reference(files, tmp_path_factory):
+    """Forecast of the float64 path, which all paths are compared to"""
+    output_file = str(tmp_path_factory.mktemp("reference") / "reference.grib2")
+    forecast = run_forecast(files, output_file, "--dtype", "float64")
+    assert len(forecast) == STEPS - 1
+    assert np.std(np.concatenate(list(forecast.values()))) > 0
+    return forecast
+
+
+def test_float32(files, reference, tmp_path):
+    assert_same_forecast(run_forecast(files, str(tmp_path / "out.grib2")), reference, DTYPE_TOLERANCE)
+
+
+@pytest.mark.parametrize("options", [
+    ["--preallocate"],
+    ["--preallocate", "--scratch_dir", "SCRATCH"],
+    ["--streaming"],
+    ["--tile_size", "2", "--inference_workers", "3", "--chunk_size", "50"],
+    ["--encode_workers", "1"],
+], ids=["preallocate", "memmap", "streaming", "tiled", "serial_encoding"])
+def test_processing_paths(files, reference, tmp_path, options):
+    options = [str(tmp_path) if option == "SCRATCH" else option for option in options]
+    forecast = run_forecast(files, str(tmp_path / "out.grib2"), "--dtype", "float64", *options)
+    assert_same_forecast(forecast, reference)
+
+
+def test_incremental(files, reference, tmp_path):
+    forecast = run_forecast(files, str(tmp_path / "out.grib2"), "--dtype", "float64", "--incremental",
+                            "--final_leadtime", str(benchmark.EC_STEPS[STEPS - 1]), "--poll_seconds", "0")
+    assert_same_forecast(forecast, reference)
+
+
+def test_feature_store(files, reference, tmp_path):
+    store_dir = str(tmp_path / "features")
+    forecast = run_forecast(files, str(tmp_path / "out.grib2"), "--dtype", "float64", "--feature_store", store_dir)
+    assert_same_forecast(forecast, reference)
+    store = os.path.join(store_dir, benchmark.BENCHMARK_START_TIME + ".zarr")
+    assert_same_forecast(run_from_feature_store(files, str(tmp_path / "rerun.grib2"), store), reference)
+
+
+def test_byte_range(files, reference, tmp_path, s3_server):
+    """Input read from S3 with range requests"""
+    s3_files = dict(files)
+    for name in tl.PREDICTOR_FILE_SUFFIXES:
+        s3_files[name] = s3_server.upload("ec/" + os.path.basename(files[name]), files[name])
+    env = dict(os.environ, S3_ENDPOINT_URL=s3_server.endpoint_url)
+    forecast = run_forecast(s3_files, str(tmp_path / "out.grib2"), "--dtype", "float64", "--byte_range", env=env)
+    assert_same_forecast(forecast, reference)
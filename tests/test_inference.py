@@ -0,0 +1,42 @@
+"""Domain inference in tiles and its effect on the shared model"""
+import json
+import numpy as np
+import pytest
+import benchmark
+import tools as tl
+
+SHAPE = (5, 4, 6)
+
+
+def booster_nthread(model) -> int:
+    return int(json.loads(model.get_booster().save_config())['learner']['generic_param']['nthread'])
+
+
+@pytest.fixture(scope="module")
+def model(tmp_path_factory):
+    model_file = str(tmp_path_factory.mktemp("model") / "model.joblib")
+    benchmark.write_synthetic_model(model_file, trees=10)
+    return tl.load_ML_model(model_file)
+
+
+@pytest.fixture
+def features():
+    rng = np.random.default_rng(0)
+    return {col: rng.normal(size=SHAPE).astype(np.float32) for col in tl.MODEL_COLUMNS}
+
+
+def test_tiles_give_the_same_forecast(model, features):
+    data = features['T2']
+    whole = tl.generate_ML_forecast_domain(features, model, data)
+    tiled = tl.generate_ML_forecast_domain(features, model, data, chunk_size=30, workers=3, tile_size=3)
+    np.testing.assert_array_equal(tiled, whole)
+
+
+def test_thread_count_of_the_model_is_restored(model, features):
+    model.get_booster().set_param({'nthread': 3})
+    tl.generate_ML_forecast_domain(features, model, features['T2'], workers=2)
+    assert booster_nthread(model) == 3
+    del features['WS']
+    with pytest.raises(KeyError):
+        tl.generate_ML_forecast_domain(features, model, features['T2'], workers=2)
+    assert booster_nthread(model) == 3
@@ -0,0 +1,32 @@
+"""Conversion of the joblib model to the inference backends and their parity"""
+import numpy as np
+import pytest
+import benchmark
+import ml_backends
+import tools as tl
+
+# Libraries each backend needs besides xgboost
+BACKEND_PACKAGES = {'booster': [], 'onnx': ['onnxruntime', 'onnxmltools'], 'treelite': ['treelite', 'tl2cgen']}
+BACKEND_FILES = {'booster': "model.ubj", 'onnx': "model.onnx", 'treelite': "model.so"}
+
+
+@pytest.fixture(scope="module")
+def model(tmp_path_factory):
+    pytest.importorskip("xgboost")
+    model_file = str(tmp_path_factory.mktemp("model") / "model.joblib")
+    benchmark.write_synthetic_model(model_file, trees=20)
+    return tl.load_ML_model(model_file)
+
+
+@pytest.mark.parametrize("backend", ['booster', 'onnx', 'treelite'])
+def test_converted_backend_predicts_like_the_model(model, backend, tmp_path):
+    for package in BACKEND_PACKAGES[backend]:
+        pytest.importorskip(package)
+    output_file = str(tmp_path / BACKEND_FILES[backend])
+    ml_backends.convert(model, backend, output_file)
+    backend_model = tl.load_ML_model(output_file, backend)
+    # The synthetic model is trained on standard normal features, so they reach its split thresholds
+    features = np.random.default_rng(1).normal(size=(2000, len(tl.MODEL_COLUMNS))).astype(np.float32)
+    assert ml_backends.check_parity(model, backend_model, features) < 1e-3
+    np.testing.assert_allclose(tl.predict_features(backend_model, features), tl.predict_features(model, features),
+                               atol=1e-3)
@@ -0,0 +1,62 @@
+"""Track point tables of the main output and of --output_formats parquet"""
+import sys
+import subprocess
+import numpy as np
+import pandas as pd
+import pytest
+import output_formats
+import tools as tl
+from test_forecast_parity import SCRIPT, REPO_DIR
+
+TIMES = pd.date_range("2024-10-18 01:00", periods=3, freq="h").to_pydatetime()
+
+
+@pytest.fixture
+def points():
+    return pd.DataFrame({'id': ['A', 'B'], 'lat': [60.1, 61.25], 'lon': [24.9, 25.5]})
+
+
+@pytest.fixture
+def forecast():
+    return (273.15 + np.array([[1.234, -2.5], [3.0, 4.561], [5.5, 6.0]])).astype(np.float32)
+
+
+def test_table_rows(points, forecast):
+    table = tl.track_point_table(points, TIMES, forecast)
+    assert list(table.columns) == ['id', 'lat', 'lon', 'time', 'rail_temperature']
+    assert list(table['id']) == ['A', 'B'] * 3
+    assert list(table['time']) == list(np.repeat(pd.to_datetime(TIMES), 2))
+    np.testing.assert_array_equal(table['rail_temperature'], [1.23, -2.5, 3.0, 4.56, 5.5, 6.0])
+    assert table['rail_temperature'].dtype == np.float64
+
+
+def test_csv_round_trip(points, forecast, tmp_path):
+    output_file = str(tmp_path / "points.csv")
+    tl.write_track_point_forecast(points, TIMES, forecast, output_file)
+    table = pd.read_csv(output_file, parse_dates=['time'])
+    expected = tl.track_point_table(points, TIMES, forecast)
+    pd.testing.assert_frame_equal(table, expected, check_dtype=False)
+
+
+def test_parquet_round_trip(points, forecast, tmp_path):
+    pytest.importorskip("pyarrow")
+    output_file = str(tmp_path / "points.parquet")
+    extra_file = str(tmp_path / "extra.parquet")
+    tl.write_track_point_forecast(points, TIMES, forecast, output_file)
+    output_formats.write_parquet(points, TIMES, forecast, path=extra_file)
+    expected = tl.track_point_table(points, TIMES, forecast)
+    for parquet_file in (output_file, extra_file):
+        table = pd.read_parquet(parquet_file)
+        table['time'] = table['time'].astype(expected['time'].dtype)
+        pd.testing.assert_frame_equal(table, expected)
+
+
+def test_unknown_extension_is_rejected(points, forecast, tmp_path):
+    output_file = str(tmp_path / "points.grib2")
+    with pytest.raises(ValueError):
+        tl.write_track_point_forecast(points, TIMES, forecast, output_file)
+    result = subprocess.run([sys.executable, SCRIPT, "--ML_model", "model.joblib", "--from_feature_store", "store.zarr",
+                             "--track_points", "points.csv", "--output_file", output_file],
+                            cwd=REPO_DIR, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    assert result.returncode == 2
+    assert "--output_file of --track_points must have one of the extensions .csv, .parquet" in result.stdout
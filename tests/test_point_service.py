@@ -0,0 +1,25 @@
+"""Point service answers against the track point table of the same forecast"""
+import numpy as np
+import pandas as pd
+import benchmark
+from point_service import ForecastCube
+from test_forecast_parity import run_forecast, NY, NX, STEPS
+
+
+def test_service_times_and_values_match_track_points(tmp_path):
+    files = benchmark.make_fixtures(str(tmp_path / "fixtures"), NY, NX, STEPS)
+    points = pd.DataFrame({'id': ['A', 'B'], 'lat': [71.75, 71.6], 'lon': [5.25, 5.5]})
+    points_file = str(tmp_path / "points.csv")
+    points.to_csv(points_file, index=False)
+    grib_file = str(tmp_path / "out.grib2")
+    table_file = str(tmp_path / "points_out.csv")
+    run_forecast(files, grib_file)
+    run_forecast(files, table_file, "--track_points", points_file, read_output=False)
+
+    table = pd.read_csv(table_file, parse_dates=['time'])
+    answer = ForecastCube(grib_file).query(points['lat'].tolist(), points['lon'].tolist())
+    times = pd.to_datetime(answer['times'])
+    assert times[0] == pd.Timestamp(benchmark.BENCHMARK_START_TIME) + pd.Timedelta(hours=1)
+    expected = table.pivot(index='time', columns='id', values='rail_temperature')
+    assert list(times) == list(expected.index)
+    np.testing.assert_allclose(np.array(answer['rail_temperature']).T, expected[['A', 'B']].values, atol=0.02)
@@ -0,0 +1,80 @@
+"""Interpolation weights of track points and their cache next to the points file"""
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import tools as tl
+
+
+def grid(lat0: float = 60.0, lon0: float = 20.0, ny: int = 10, nx: int = 12, step: float = 0.1):
+    return np.meshgrid(lat0 + step * np.arange(ny), lon0 + step * np.arange(nx), indexing="ij")
+
+
+@pytest.fixture
+def points_file(tmp_path):
+    points = pd.DataFrame({'id': ['inside', 'on_grid', 'outside'],
+                           'lat': [60.33, 60.5, 30.0], 'lon': [20.47, 20.6, 60.0]})
+    path = str(tmp_path / "points.csv")
+    points.to_csv(path, index=False)
+    return path
+
+
+def test_weights_sum_to_one():
+    latitudes, longitudes = grid()
+    rng = np.random.default_rng(0)
+    point_lats, point_lons = rng.uniform(60, 60.9, 50), rng.uniform(20, 21.1, 50)
+    indices, weights = tl.point_interpolation_weights(latitudes, longitudes, point_lats, point_lons)
+    assert indices.shape == weights.shape == (50, 4)
+    np.testing.assert_allclose(weights.sum(axis=1), 1)
+    assert np.all(weights >= 0)
+    # A linear field is interpolated close to its value at the point
+    field = latitudes + 2 * longitudes
+    np.testing.assert_allclose(tl.interpolate_to_points(field, indices, weights), point_lats + 2 * point_lons, atol=0.1)
+
+
+def test_points_outside_the_grid_get_nan(points_file):
+    latitudes, longitudes = grid()
+    _, indices, weights = tl.load_track_point_weights(points_file, latitudes, longitudes)
+    values = tl.interpolate_to_points(latitudes, indices, weights)
+    np.testing.assert_allclose(np.nansum(weights[:2], axis=1), 1)
+    assert values[1] == pytest.approx(60.5)
+    assert np.isfinite(values[0]) and np.isnan(values[2])
+
+
+def test_cached_weights_are_reused_for_the_same_grid(points_file, monkeypatch):
+    latitudes, longitudes = grid()
+    _, indices, weights = tl.load_track_point_weights(points_file, latitudes, longitudes)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("weights were not read from the cache")
+
+    monkeypatch.setattr(tl, "point_interpolation_weights", fail)
+    _, cached_indices, cached_weights = tl.load_track_point_weights(points_file, latitudes, longitudes)
+    np.testing.assert_array_equal(cached_indices, indices)
+    np.testing.assert_array_equal(cached_weights, weights)
+
+
+def test_changed_grid_invalidates_cached_weights(points_file):
+    latitudes, longitudes = grid()
+    _, indices, weights = tl.load_track_point_weights(points_file, latitudes, longitudes)
+    shifted_lats, shifted_lons = grid(lat0=60.05, lon0=20.05)
+    _, new_indices, new_weights = tl.load_track_point_weights(points_file, shifted_lats, shifted_lons)
+    expected = tl.point_interpolation_weights(shifted_lats, shifted_lons, [60.33, 60.5, 30.0], [20.47, 20.6, 60.0],
+                                              max_distance=tl.grid_step(shifted_lats, shifted_lons))
+    np.testing.assert_array_equal(new_indices, expected[0])
+    np.testing.assert_array_equal(new_weights, expected[1])
+    assert not np.array_equal(new_weights[:2], weights[:2])
+    cache_files = [name for name in os.listdir(os.path.dirname(points_file)) if name.endswith(".npz")]
+    assert len(cache_files) == 2
+
+
+def test_cache_of_other_points_is_not_used(points_file):
+    latitudes, longitudes = grid()
+    tl.load_track_point_weights(points_file, latitudes, longitudes)
+    pd.DataFrame({'id': ['a'], 'lat': [60.2], 'lon': [20.2]}).to_csv(points_file, index=False)
+    # The cache is newer than the rewritten points file, as when a file is replaced within the mtime resolution
+    for name in os.listdir(os.path.dirname(points_file)):
+        if name.endswith(".npz"):
+            os.utime(os.path.join(os.path.dirname(points_file), name), (2e9, 2e9))
+    _, indices, weights = tl.load_track_point_weights(points_file, latitudes, longitudes)
+    assert indices.shape == weights.shape == (1, 4)
@@ -1,29 +1,74 @@
+from __future__ import annotations
+import os
+import json
+import hashlib
 import numpy as np
-import xarray as xr
 import warnings
-import pandas as pd
-import fsspec
-import joblib
-from datetime import datetime as dt
+from concurrent.futures import ThreadPoolExecutor
+from file_cache import FileCache, S3_ENDPOINTS
+import features as ft
+import ml_backends
+from lazy_imports import lazy_import
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
+# Heavy libraries are imported on first use
+xr = lazy_import("xarray")
+pd = lazy_import("pandas")
+fsspec = lazy_import("fsspec")
+joblib = lazy_import("joblib")
+spatial = lazy_import("scipy.spatial")
+
+FILE_CACHE = None
+
+# Station identifier column of long-format multi-station point input
+STATION_COLUMN = 'station'
+
+# Input file name suffixes of the predictors in the EC data bucket
+PREDICTOR_FILE_SUFFIXES = {'T2': 'T-K_2',
+                           'D2': 'TD-K_2',
+                           'SKT': 'T-K_0',
+                           'T_925': 'T-K_925',
+                           'WS': 'FF-MS_10',
+                           'LCC': 'NL-PRCNT_0',
+                           'MCC': 'NM-PRCNT_0',
+                           'SRR1h': 'RNETSWA-JM2_0',
+                           'STR1h': 'RNETLWA-JM2_0'}
+
+
+def configure_file_cache(cache_dir: str, max_size_gb: float = None) -> FileCache:
+    global FILE_CACHE
+    max_size = None if max_size_gb is None else int(max_size_gb * 1e9)
+    FILE_CACHE = FileCache(cache_dir, max_size)
+    return FILE_CACHE
+
+
+def predictor_files_for_start_time(start_time: str, prefix: str = "s3://trail/ec/") -> dict:
+    return {param: "{}{}_{}.grib2".format(prefix, start_time, suffix)
+            for param, suffix in PREDICTOR_FILE_SUFFIXES.items()}
+
 
 def read_file_from_s3(data_file):
+    if FILE_CACHE is not None:
+        return FILE_CACHE.get(data_file)
     uri = "simplecache::{}".format(data_file)
-    try:
-        return fsspec.open_local(
-            uri, s3={'anon': True,
-                     'client_kwargs': {'endpoint_url': 'https://routines-data.lake.fmi.fi'}})
-    except FileNotFoundError as e:
-        return fsspec.open_local(
-            uri, s3={'anon': True,
-                     'client_kwargs': {'endpoint_url': 'https://lake.fmi.fi'}})
+    # Keep the file name, ReadData recognizes GRIB files by it
+    simplecache = {'same_names': True}
+    for endpoint_url in S3_ENDPOINTS[:-1]:
+        try:
+            return fsspec.open_local(uri, s3={'anon': True, 'client_kwargs': {'endpoint_url': endpoint_url}},
+                                     simplecache=simplecache)
+        except FileNotFoundError:
+            continue
+    return fsspec.open_local(uri, s3={'anon': True, 'client_kwargs': {'endpoint_url': S3_ENDPOINTS[-1]}},
+                             simplecache=simplecache)
 
 
-def load_ML_model(path: str):
+def load_ML_model(path: str, backend: str = 'joblib'):
     model_file = path
     if path.startswith("s3://"):
         model_file = read_file_from_s3(path)
+    if backend != 'joblib':
+        return ml_backends.load_backend(model_file, backend)
     regressor = joblib.load(model_file)
     return regressor
 
@@ -40,34 +85,288 @@ def fetch_basic_predictor_files(args) -> dict:
             'STR1h': args.STR1h}
 
 
-def generate_ML_forecast_domain(ds, model, data):
-    rail_temp_fcst = np.zeros(shape=data.shape)
-    for i in range(len(ds['time'].values)):
-        df = select_domain_data_from_ds(ds, i)
-        temp_fcst = model.predict(df)
-        rail_temp_fcst[i] = (temp_fcst.reshape(rail_temp_fcst[0].shape))
+MODEL_COLUMNS = ['forecast_period', 'T2', 'D2', 'SKT', 'T_925', 'WS', 'LCC', 'MCC',
+                 'sinhour', 'coshour', 'sinmonth', 'cosmonth', 'SRR1h', 'STR1h', 'month']
+
+# Maximum number of feature rows handed to the model in one call
+INFERENCE_CHUNK_SIZE = 2_000_000
+
+# Table formats of the --track_points output by file extension
+TRACK_POINT_FORMATS = {'.csv': 'csv', '.parquet': 'parquet'}
+
+
+def generate_ML_forecast_domain(ds, model, data, chunk_size: int = INFERENCE_CHUNK_SIZE,
+                                workers: int = 1, tile_size: int = None):
+    """Predict the whole forecast cube in tiles of time steps x grid rows
+
+    Tiles are predicted concurrently by workers threads sharing the model, the
+    XGBoost threads are divided between them. Each grid point is predicted
+    independently, so results do not depend on the tiling.
+    """
+    rail_temp_fcst = np.zeros(shape=data.shape, dtype=data.dtype)
+    # Ensemble members of a (member, time, y, x) cube are predicted in the same tiles
+    steps, ny, nx = data.shape[-3:]
+    rows = ny if tile_size is None else tile_size
+    cells_per_step = rows * nx * int(np.prod(data.shape[:-3]))
+    steps_per_chunk = max(1, chunk_size // cells_per_step)
+    tiles = [(slice(start, min(start + steps_per_chunk, steps)), slice(row, min(row + rows, ny)))
+             for start in range(0, steps, steps_per_chunk)
+             for row in range(0, ny, rows)]
+
+    def predict_tile(tile):
+        features = build_feature_matrix(ds, *tile)
+        index = (Ellipsis,) + tile + (slice(None),)
+        rail_temp_fcst[index] = predict_features(model, features).reshape(rail_temp_fcst[index].shape)
+
+    booster = model.get_booster() if workers > 1 and hasattr(model, 'get_booster') else None
+    if booster is not None:
+        # The model is shared with later calls, its thread count is restored afterwards
+        nthread = json.loads(booster.save_config())['learner']['generic_param']['nthread']
+        booster.set_param({'nthread': max(1, (os.cpu_count() or 1) // workers)})
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(predict_tile, tiles))
+    finally:
+        if booster is not None:
+            booster.set_param({'nthread': int(nthread)})
     return rail_temp_fcst
 
 
+def build_feature_matrix(ds, times, rows=slice(None), columns=MODEL_COLUMNS):
+    """Assemble model features of a tile of time steps and grid rows as one contiguous float32 matrix
+
+    The tile includes every ensemble member of (member, time, x, y) features.
+    """
+    # ds is an xr.Dataset or a dict of arrays, indexing before the conversion reads only the
+    # needed chunks of a lazily opened feature store
+    return assemble_features({col: np.asarray(ds[col][..., times, rows, :]) for col in columns}, columns)
+
+
+def assemble_features(fields: dict, columns=MODEL_COLUMNS):
+    """Stack equally shaped (or broadcastable scalar) fields into a (points, columns) float32 matrix"""
+    shape = np.broadcast_shapes(*[np.shape(fields[col]) for col in columns])
+    features = np.empty(shape=shape + (len(columns),), dtype=np.float32)
+    for k, col in enumerate(columns):
+        features[..., k] = fields[col]
+    return features.reshape(-1, len(columns))
+
+
+def generate_ML_forecast_stream(grib_files: dict, model, times, start: int = 1, previous: dict = None):
+    """Yield the forecast of one lead time at a time
+
+    grib_files gives lazy readers of the basic predictors, times the forecast times
+    including the analysis time. Each step is decoded, featurized and predicted on
+    its own; only the previous radiation accumulations are kept for de-accumulation.
+    When resuming from step start, previous must hold the accumulations of step
+    start - 1. It is updated in place, so the caller can persist it.
+    """
+    forecast_period = ft.forecast_period_hours(times)
+    angles = ft.time_angle_features(times)
+    increments = ft.time_step_increments(forecast_period) * 3600.0
+    previous = {} if previous is None else previous
+    for i in range(start, len(times)):
+        fields = {}
+        for param_name, grib_file in grib_files.items():
+            values = grib_file[i]
+            values[values == 9999] = np.nan
+            fields[param_name] = values
+        for param_name in ['SRR1h', 'STR1h']:
+            accumulated = fields[param_name]
+            if i == 1:
+                fields[param_name] = accumulated / 3600
+            else:
+                fields[param_name] = (accumulated - previous[param_name]) / float(increments[i])
+            previous[param_name] = accumulated
+        for param_name in ['LCC', 'MCC']:
+            fields[param_name] = fields[param_name] / 100
+        fields['forecast_period'] = forecast_period[i]
+        for key, angle_values in angles.items():
+            fields[key] = angle_values[i]
+        temp_fcst = predict_features(model, assemble_features(fields))
+        yield temp_fcst.reshape(fields['T2'].shape)
+
+
+def predict_features(model, features):
+    """Predict with the native XGBoost booster when available, bypassing sklearn input validation"""
+    if hasattr(model, 'get_booster'):
+        best_iteration = getattr(model, 'best_iteration', None)
+        iteration_range = (0, best_iteration + 1) if best_iteration is not None else (0, 0)
+        return model.get_booster().inplace_predict(features, iteration_range=iteration_range,
+                                                   missing=getattr(model, 'missing', np.nan))
+    return model.predict(features)
+
+
+def ensemble_products(forecast, percentiles: list, thresholds: list) -> tuple:
+    """Percentiles and exceedance probabilities (%) over the members of a (member, time, y, x) forecast
+
+    Each is one vectorized reduction over the member axis of the whole cube.
+    Thresholds are in the unit of forecast.
+    """
+    quantiles = np.percentile(forecast, percentiles, axis=0).astype(forecast.dtype)
+    thresholds = np.asarray(thresholds, dtype=forecast.dtype).reshape((-1,) + (1,) * forecast.ndim)
+    probabilities = 100 * np.mean(forecast > thresholds, axis=1, dtype=forecast.dtype)
+    return quantiles, probabilities
+
+
 def select_domain_data_from_ds(ds, i):
-    columns_to_select = ['forecast_period', 'T2', 'D2', 'SKT', 'T_925', 'WS', 'LCC', 'MCC',
-                         'sinhour', 'coshour', 'sinmonth', 'cosmonth', 'SRR1h', 'STR1h', 'month']
-    data = {col: ds[col].values[i].flatten() for col in columns_to_select}
+    data = {col: ds[col].values[i].flatten() for col in MODEL_COLUMNS}
     df = pd.DataFrame(data)
     return df
 
 
 def generate_ML_forecast_points(ds, model):
-    len_x = len(ds.T2.values[0, :, 0])
-    len_y = len(ds.T2.values[0, 0, :])
-    rail_temp_fcst = np.array([[model.predict(select_df_data_from_ds(ds, i, j)) for j in range(len_y)] for i in range(len_x)])
-    rail_temp_fcst = np.transpose(rail_temp_fcst, (2, 0, 1)) - 273.15
+    columns = ['lat', 'lon'] + MODEL_COLUMNS
+    fields = {col: ds[col].values for col in columns}
+    rail_temp_fcst = model.predict(assemble_features(fields, columns))
+    rail_temp_fcst = rail_temp_fcst.reshape(ds.T2.values.shape) - 273.15
     return rail_temp_fcst
 
 
+def point_interpolation_weights(latitudes, longitudes, point_lats, point_lons, neighbours: int = 4,
+                                tree=None, max_distance: float = None):
+    """Grid indices and inverse distance weights of the nearest grid points of every point
+
+    Returns flat indices into the (nj, ni) grid and weights, both of shape (points, neighbours).
+    tree is the grid_tree() of the grid, built here if not given. Points farther than
+    max_distance (see grid_step()) from the nearest grid point are outside the grid
+    and get NaN weights.
+    """
+    if tree is None:
+        tree = grid_tree(latitudes, longitudes)
+    distances, indices = tree.query(lat_lon_to_xyz(np.ravel(point_lats), np.ravel(point_lons)), k=neighbours)
+    distances = distances.reshape(-1, neighbours)
+    indices = indices.reshape(-1, neighbours)
+    weights = 1 / np.maximum(distances, 1e-12) ** 2
+    # A point on top of a grid point takes its value only
+    exact = distances[:, 0] < 1e-9
+    weights[exact] = 0
+    weights[exact, 0] = 1
+    weights /= weights.sum(axis=1, keepdims=True)
+    if max_distance is not None:
+        weights[distances[:, 0] > max_distance] = np.nan
+    return indices, weights
+
+
+def grid_tree(latitudes, longitudes):
+    """KD-tree of the grid points, built once per grid for point_interpolation_weights()"""
+    return spatial.cKDTree(lat_lon_to_xyz(np.ravel(latitudes), np.ravel(longitudes)))
+
+
+def grid_step(latitudes, longitudes) -> float:
+    """Longest distance between neighbouring points of a (nj, ni) grid, in the units of lat_lon_to_xyz()
+
+    A point inside the grid is always closer than that to its nearest grid point.
+    """
+    xyz = lat_lon_to_xyz(np.ravel(latitudes), np.ravel(longitudes)).reshape(np.shape(latitudes) + (3,))
+    return max(float(np.linalg.norm(np.diff(xyz, axis=axis), axis=-1).max()) for axis in (0, 1))
+
+
+def lat_lon_to_xyz(lats, lons):
+    lats = np.radians(np.asarray(lats, dtype=float))
+    lons = np.radians(np.asarray(lons, dtype=float))
+    return np.column_stack([np.cos(lats) * np.cos(lons), np.cos(lats) * np.sin(lons), np.sin(lats)])
+
+
+def read_track_points(points_file: str):
+    """Read rail network points from CSV (columns lat, lon and optional id) or GeoJSON
+
+    Every vertex of GeoJSON (Multi)LineString geometries becomes a point.
+    """
+    if not points_file.endswith(('.json', '.geojson')):
+        points = pd.read_csv(points_file, sep=None, engine='python')
+        if 'id' not in points.columns:
+            points.insert(0, 'id', np.arange(len(points)))
+        return points[['id', 'lat', 'lon']]
+
+    with open(points_file) as fp:
+        features = json.load(fp)['features']
+    rows = []
+    for k, feature in enumerate(features):
+        geometry = feature['geometry']
+        coordinates = geometry['coordinates']
+        if geometry['type'] == 'Point':
+            coordinates = [coordinates]
+        elif geometry['type'] in ('MultiLineString', 'Polygon'):
+            coordinates = [c for line in coordinates for c in line]
+        feature_id = (feature.get('properties') or {}).get('id', k)
+        rows.extend((feature_id, lat, lon) for lon, lat, *_ in coordinates)
+    return pd.DataFrame(rows, columns=['id', 'lat', 'lon'])
+
+
+def load_track_point_weights(points_file: str, latitudes, longitudes):
+    """Interpolation weights of the track points, cached next to the points file per grid
+
+    Points outside the grid get NaN weights and so a NaN forecast.
+    """
+    grid_hash = hashlib.sha256(np.ascontiguousarray(latitudes).tobytes() +
+                               np.ascontiguousarray(longitudes).tobytes()).hexdigest()[:16]
+    weights_file = "{}.{}.npz".format(points_file, grid_hash)
+    points = read_track_points(points_file)
+    if os.path.exists(weights_file) and os.stat(weights_file).st_mtime >= os.stat(points_file).st_mtime:
+        cached = np.load(weights_file)
+        if cached['weights'].shape[0] == len(points):
+            return points, cached['indices'], cached['weights']
+        print("Track point weights {} do not match the points, computing them again".format(weights_file))
+    indices, weights = point_interpolation_weights(latitudes, longitudes, points['lat'].values, points['lon'].values,
+                                                   max_distance=grid_step(latitudes, longitudes))
+    try:
+        np.savez(weights_file, indices=indices, weights=weights)
+    except OSError as e:
+        print("Could not cache track point weights {}: {}".format(weights_file, e))
+    return points, indices, weights
+
+
+def generate_ML_forecast_track_points(ds, model, indices, weights):
+    """Predict only the grid cells around the track points and interpolate to the points
+
+    Returns an array of shape (time, points).
+    """
+    cells, inverse = np.unique(indices, return_inverse=True)
+    shape = ds['T2'].shape
+    rows, cols = np.unravel_index(cells, shape[1:])
+    fields = {col: np.asarray(ds[col])[:, rows, cols] for col in MODEL_COLUMNS}
+    cell_fcst = predict_features(model, assemble_features(fields)).reshape(shape[0], len(cells))
+    return (cell_fcst[:, inverse.reshape(indices.shape)] * weights).sum(axis=-1)
+
+
+def track_point_table(points, times, forecast):
+    """Long table of the (time, points) forecast in Celsius, one row per track point and time sorted by time"""
+    return pd.DataFrame({'id': np.tile(points['id'].values, len(times)),
+                         'lat': np.tile(points['lat'].values, len(times)),
+                         'lon': np.tile(points['lon'].values, len(times)),
+                         'time': np.repeat(np.asarray(times, dtype='datetime64[s]'), len(points)),
+                         'rail_temperature': np.round(np.asarray(forecast, dtype=np.float64).ravel() - 273.15, 2)})
+
+
+def track_point_format(output_file: str):
+    """Table format of a track point output file by its extension, None if it is not a table"""
+    return TRACK_POINT_FORMATS.get(os.path.splitext(output_file)[1].lower())
+
+
+def write_track_point_forecast(points, times, forecast, output_file: str):
+    """Write the forecast of every track point and time as a long table in CSV or Parquet by the file extension"""
+    output_format = track_point_format(output_file)
+    if output_format is None:
+        raise ValueError("Unknown track point output format of '{}', use one of {}".format(
+            output_file, ", ".join(TRACK_POINT_FORMATS)))
+    table = track_point_table(points, times, forecast)
+    if output_format == 'parquet':
+        table.to_parquet(output_file, index=False, compression="zstd")
+    else:
+        table.to_csv(output_file, index=False)
+    print("wrote file '%s'" % output_file)
+
+
+def interpolate_to_points(data, indices, weights):
+    """Interpolate fields of shape (..., nj, ni) to points, returns shape (..., points)"""
+    flat = data.reshape(data.shape[:-2] + (-1,))
+    return (flat[..., indices] * weights).sum(axis=-1)
+
+
 def select_df_data_from_ds(ds, i, j):
-    data = {'lat': ds['lat'].values[:, i, j],
-            'lon': ds['lon'].values[:, i, j],
+    steps = ds['T2'].shape[0]
+    data = {'lat': np.repeat(ds['lat'].values[i, j], steps),
+            'lon': np.repeat(ds['lon'].values[i, j], steps),
             'forecast_period': ds['forecast_period'].values[:, i, j],
             'T2': ds['T2'].values[:, i, j],
             'D2': ds['D2'].values[:, i, j],
@@ -93,21 +392,27 @@ def add_data_to_dataset_2d(param_name, ds, i) -> xr.Dataset:
 
 
 def expand_array_with_time_dimension(time, data):
-    new_lat = np.zeros(shape=(len(time), len(data[0][0:]), len(data[0][0])))
-    new_lon = np.zeros(shape=(len(time), len(data[0][0:]), len(data[0][0])))
-    for i in range(len(time) - 1):
-        new_lat[i, :, :] = data[0]
-        new_lon[i, :, :] = data[-1]
+    shape = (len(time),) + np.shape(data[0])
+    new_lat = np.broadcast_to(data[0], shape)
+    new_lon = np.broadcast_to(data[-1], shape)
     return new_lat, new_lon
 
 
+def dataset_dims(ndim: int) -> list:
+    """Dimensions of a (time, x, y) field, or of a (member, time, x, y) ensemble field"""
+    return ["member", "time", "x", "y"][-ndim:]
+
+
 def create_dataset(data_object, param_name) -> xr.Dataset:
-    lat, lon = expand_array_with_time_dimension(data_object.dtime, (data_object.latitudes, data_object.longitudes))
+    # The grid does not change in time, so lat and lon are 2-D coordinates
+    coords = dict(lon=(["x", "y"], data_object.longitudes),
+                  lat=(["x", "y"], data_object.latitudes),
+                  time=data_object.dtime[1:])
+    if data_object.data.ndim == 4:
+        coords['member'] = data_object.members
     ds = xr.Dataset(
-        data_vars=dict(data=(["time", "x", "y"], data_object.data[1:, :, :])),
-        coords=dict(lon=(["time", "x", "y"], lon[1:, :, :]),
-                    lat=(["time", "x", "y"], lat[1:, :, :]),
-                    time=data_object.dtime[1:]),
+        data_vars=dict(data=(dataset_dims(data_object.data.ndim), data_object.data[..., 1:, :, :])),
+        coords=coords,
         attrs=dict(description="Basic weather param predictors for railtrack temperature forecast."),
     )
     ds = ds.rename(name_dict={'data': param_name})
@@ -115,7 +420,7 @@ def create_dataset(data_object, param_name) -> xr.Dataset:
 
 
 def add_data_to_dataset(data_object, param_name, ds) -> xr.Dataset:
-    ds[param_name] = (["time", "x", "y"], data_object.data[1:, :, :])
+    ds[param_name] = (dataset_dims(data_object.data.ndim), data_object.data[..., 1:, :, :])
     return ds
 
 
@@ -124,49 +429,33 @@ def sort_by_time_series(ds: xr.Dataset) -> xr.Dataset:
     return ds
 
 
-def select_only_forecast_from_df(df):
-    ds = df[1:]
+def select_only_forecast_from_df(df, station_column: str = STATION_COLUMN):
+    ds = df[station_groups(df, station_column).cumcount().values > 0]
     return ds
 
 
 def mask_missing_data(data_object):
-    data_object.data[~np.isfinite(data_object.mask_nodata)] = np.nan
+    if data_object.mask_nodata is not None:
+        data_object.data[~np.isfinite(data_object.mask_nodata)] = np.nan
     data_object.data[data_object.data == 9999] = np.nan
     return data_object
 
 
 def calculate_forecast_period_dataset(times: np.array, df: xr.Dataset):
-    forecast_period = []
-    for i in range(len(times)):
-        analysis_time = times[0]
-        forecast_time = times[i]
-        diff = forecast_time - analysis_time
-        forecast_period.append(int(diff.days * 24 + diff.seconds / 3600))
-    forecast_period = expand_array_with_domain(np.array(forecast_period), df["T2"].values)
-    df['forecast_period'] = (["time", "x", "y"], np.array(forecast_period))
+    forecast_period = expand_array_with_domain(ft.forecast_period_hours(times), df["T2"].values)
+    df['forecast_period'] = (df["T2"].dims, forecast_period)
     return df
 
 
 def calculate_hourly_values_dataset(data: np.array, name: str, df: xr.Dataset):
-    param_new = np.zeros(shape=data.shape)
-    period = list(df['forecast_period'].values[:, 0, 0])
-    for i, time_step in enumerate(period):
-        increment = 1
-        if 90 <= int(time_step) < 144:
-            increment = 3
-        elif int(time_step) >= 144:
-            increment = 6
-        if i <= 0:
-            param_new[i + 1] = (data[i + 1]) / 3600
-            continue
-        param_new[i + 1] = (data[i + 1] - data[i]) / (increment * 3600)
-    df[name] = (["time", "x", "y"], param_new[1:])
+    period = df['forecast_period'].isel(x=0, y=0, member=0, missing_dims='ignore').values
+    df[name] = (df["T2"].dims, ft.hourly_values(data, period, dtype=df["T2"].dtype, axis=data.ndim - 3))
     return df
 
 
 def convert_percentage_to_zero_one(param_names: list, df: xr.Dataset) -> xr.Dataset:
     for name in param_names:
-        df[name] = (["time", "x", "y"], df[name].values / 100)
+        df[name] = (df[name].dims, df[name].values / 100)
     return df
 
 
@@ -182,32 +471,23 @@ def calculate_wind_speed(df):
 
 
 def calculate_angle_time_dataset(times: np.array, df: xr.Dataset) -> xr.Dataset:
-    angles = {
-        'sinhour': np.array([np.round((np.sin((ftime.hour*2*np.pi) / 24)), 2) for ftime in times]),
-        'coshour':  np.array([np.round((np.cos((ftime.hour * 2 * np.pi) / 24)), 2) for ftime in times]),
-        'sinmonth': np.array([np.round((np.sin((ftime.month * 2 * np.pi) / 12)), 2) for ftime in times]),
-        'cosmonth': np.array([np.round((np.cos((ftime.month * 2 * np.pi) / 12)), 2) for ftime in times]),
-        'month': np.array([ftime.month for ftime in times])
-    }
-
+    angles = ft.time_angle_features(times)
     domain_values = df["T2"].values
     for key, angle_values in angles.items():
         expanded_values = expand_array_with_domain(angle_values, domain_values)
-        df[key] = (["time", "x", "y"], expanded_values)
+        df[key] = (df["T2"].dims, expanded_values)
     return df
 
 
 def expand_array_with_domain(data: np.array, array_origin):
-    new_data = np.zeros(shape=array_origin.shape)
-    for i in range(len(data) - 1):
-        new_data[i] = np.tile(data[i+1], array_origin[0].shape)
-    return new_data
+    """Broadcast per-time values, without the analysis time, over the domain (and members) of array_origin"""
+    return ft.broadcast_over_domain(np.asarray(data[1:], dtype=array_origin.dtype), array_origin.shape,
+                                    axis=array_origin.ndim - 3)
 
 
 def convert_timestr_datetime(df):
     date_format = '%Y%m%dT%H%M%S'
-    times = df['time'].values
-    df['time'] = [dt.strptime(t, date_format) for t in times]
+    df['time'] = pd.to_datetime(df['time'], format=date_format)
     return df
 
 
@@ -237,9 +517,18 @@ def select_forecast_params_old(df):
 
 
 def read_csv_file(csv_file: str):
+    if csv_file.endswith('.parquet'):
+        return pd.read_parquet(csv_file)
     return pd.read_csv(csv_file, sep=' ')
 
 
+def station_groups(df, station_column: str = STATION_COLUMN):
+    """Group rows of a long-format multi-station table, a table without station column is one station"""
+    if station_column in df.columns:
+        return df.groupby(station_column, sort=False)
+    return df.groupby(np.zeros(len(df), dtype=int), sort=False)
+
+
 def rename_dataframe_columns(df):
     df.rename(columns={"T-K": "T2",
                        "TD-K": "D2",
@@ -264,39 +553,30 @@ def rename_dataframe_columns_old(df):
     return df
 
 
-def calculate_forecast_period_dataframe(df):
-    forecast_period = []
-    for i in range(len(df['time'].values)):
-        analysis_time = df['time'][0]
-        forecast_time = df['time'][i]
-        diff = forecast_time - analysis_time
-        forecast_period.append(diff.days * 24 + diff.seconds / 3600)
-    df.insert(3, 'forecast_period', forecast_period, True)
+def calculate_forecast_period_dataframe(df, station_column: str = STATION_COLUMN):
+    analysis_time = station_groups(df, station_column)['time'].transform('first')
+    diff = df['time'] - analysis_time
+    forecast_period = diff.dt.days * 24 + diff.dt.seconds / 3600
+    df.insert(3, 'forecast_period', forecast_period.values, True)
     return df
 
 
-def calculate_hourly_values_dataframe(params: list, df):
-    copy = df.copy()
+def calculate_hourly_values_dataframe(params: list, df, station_column: str = STATION_COLUMN):
+    groups = station_groups(df, station_column)
+    position = groups.cumcount().values
+    # Accumulation period of a row is set by the forecast period of the previous row
+    increments = ft.time_step_increments(groups['forecast_period'].shift(1).values) * 3600
     for param in params:
-        param_data = df[param].values
-        for i, time_step in enumerate(df['forecast_period'].values[:-1]):
-            increment = 1
-            if 90 <= time_step < 144:
-                increment = 3
-            elif time_step >= 144:
-                increment = 6
-            if i <= 0:
-                df.at[i + 1, param] = (param_data[i + 1]) / 3600
-                continue
-            df.at[i + 1, param] = (param_data[i + 1] - copy[param].values[i]) / (increment * 3600)
+        values = df[param].values
+        previous = groups[param].shift(1).values
+        hourly = np.where(position == 1, values / 3600, (values - previous) / increments)
+        df[param] = np.where(position == 0, values, hourly)
     return df
 
 
 def calculate_angle_time_dataframe(df):
-    forecast_time = df['time']
-    df['sinhour'] = [np.round((np.sin((ftime.hour*2*np.pi) / 24)), 2) for ftime in forecast_time]
-    df['coshour'] = [np.round((np.cos((ftime.hour * 2 * np.pi) / 24)), 2) for ftime in forecast_time]
-    df['sinmonth'] = [np.round((np.sin((ftime.month * 2 * np.pi) / 12)), 2) for ftime in forecast_time]
-    df['cosmonth'] = [np.round((np.cos((ftime.month * 2 * np.pi) / 12)), 2) for ftime in forecast_time]
-    df['month'] = [ftime.month for ftime in forecast_time]
+    angles = ft.time_angle_features(df['time'].values)
+    for key, angle_values in angles.items():
+        df[key] = angle_values
+    df['month'] = df['month'].astype(int)
     return df